@@ -0,0 +1,109 @@
+import heapq
+
+import numpy as np
+
+from recommendations import sim_pearson, top_matches
+from sparseprefs import sparse_prefs
+
+
+# Candidate index for top_matches over the people who share items with
+# a person, scoring the ones with the fewest shared items first.
+#
+# sim_pearson and sim_distance only look at the items two people both
+# rated and reach their extremes on few of them: two people who rated
+# the same two movies in the same order have a Pearson score of 1.0.
+# On ml-latest-small the 5th best exact score is 1.0 for 88% of the
+# people, tied among about 20 people who mostly share just 2 movies
+# with them. Random-projection LSH of whole rating profiles was tried
+# first and found no more of these than a random sample of the same
+# size: profiles overlap in a handful of 9700 movies, so the hash sees
+# almost the same angle between any two of them.
+#
+# A query counts the items every person shares with the profile (from
+# the inverted item -> raters lists, so it costs the ratings of those
+# items, not a similarity per person), keeps the people sharing at
+# least min_shared items (2 for sim_pearson, which scores fewer as 0)
+# and scores the first `share` of all people in order of fewest shared
+# items with the real similarity function, so the results are exact
+# scores for an approximate candidate set. share is the recall/latency
+# knob, 1.0 scores everyone who can score above 0.
+#
+# On ml-latest-small, sim_pearson, share 0.05 finds 94% of the exact
+# top 5 (recall) in 0.6 ms against 7.9 ms for top_matches, share 0.1
+# 99% in 0.8 ms; a random 5% finds 21%. For the 12% of people without
+# a tie at 1.0 it is 74% at 0.05 and 94% at 0.2. Check recall on your
+# own data and similarity before trading exactness for speed.
+#
+# Build it on transform_prefs(prefs) for item vectors.
+class CoRatingIndex:
+    def __init__(self, prefs, share=0.1):
+        if not hasattr(prefs, 'similarity_block'):
+            prefs = sparse_prefs(prefs)
+        self.share = share
+        self.people = prefs.people
+        self.person_index = prefs.person_index
+        self.item_index = prefs.item_index
+        # item x people, the raters of item i are row i
+        self.raters = prefs.rated.T.tocsr()
+
+    def shared(self, ratings):
+        # Number of the {item: rating} profile's items every person rated
+        cols = np.array([self.item_index[item] for item in ratings if item in self.item_index],
+                        dtype=np.int64)
+        starts, ends = self.raters.indptr[cols], self.raters.indptr[cols + 1]
+        counts = ends - starts
+        entries = np.arange(counts.sum()) + np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return np.bincount(self.raters.indices[entries], minlength=len(self.people))
+
+    def candidates(self, ratings, share=None, min_shared=1, exclude=None):
+        # Sorted rows of the people to score: those sharing at least
+        # min_shared items, fewest shared first, at most share of everyone
+        if share is None:
+            share = self.share
+        shared = self.shared(ratings)
+        if exclude is not None:
+            shared[exclude] = 0
+        found = np.flatnonzero(shared >= max(min_shared, 1))
+        limit = int(np.ceil(share * len(self.people)))
+        return np.sort(found[np.argsort(shared[found], kind='mergesort')[:limit]])
+
+    def top_matches(self, prefs, person, n=5, similarity=sim_pearson, share=None, exact=False):
+        # Same result format as recommendations.top_matches. With
+        # exact=True it is the brute-force answer, for checking recall.
+        if exact:
+            return top_matches(prefs, person, n=n, similarity=similarity)
+        min_shared = 2 if similarity is sim_pearson else 1
+        others = self.candidates(prefs[person], share, min_shared,
+                                 self.person_index.get(person)).tolist()
+        if hasattr(prefs, 'similarity_to') and prefs.people is self.people \
+                and similarity in prefs.vectorized:
+            scores = prefs.similarity_to(self.person_index[person], others, similarity).tolist()
+        else:
+            scores = [similarity(prefs, person, self.people[other]) for other in others]
+        return heapq.nlargest(n, zip(scores, [self.people[other] for other in others]))
+
+
+# Share of the exact top n (recommendations.top_matches) that the index
+# finds, averaged over people. A result counts when its score reaches
+# the n-th exact score, so a person tied with the exact ones is not a
+# miss just because top_matches broke the tie the other way.
+def recall(index, prefs, people, n=5, similarity=sim_pearson, share=None):
+    hits = 0
+    total = 0
+    for person in people:
+        exact = top_matches(prefs, person, n=n, similarity=similarity)
+        if not exact:
+            continue
+        approx = index.top_matches(prefs, person, n=n, similarity=similarity, share=share)
+        last = exact[-1][0]
+        hits += min(len(exact), len([score for score, other in approx if score >= last - 1e-9]))
+        total += len(exact)
+    return float(hits) / max(total, 1)
+
+
+# Share of the other people the index scores per query, the price of recall
+def probed(index, prefs, people, share=None, similarity=sim_pearson):
+    min_shared = 2 if similarity is sim_pearson else 1
+    found = sum(len(index.candidates(prefs[person], share, min_shared, index.person_index[person]))
+                for person in people)
+    return float(found) / max(len(people) * (len(index.people) - 1), 1)
@@ -0,0 +1,59 @@
+import multiprocessing
+import sys
+import time
+
+from recommendations import personbased_recommend
+from sparseprefs import sparse_prefs
+from util import load_movielens
+
+# Set right before the pool starts. The workers are forked, so they read
+# the parent's copy (copy-on-write) instead of getting prefs pickled with
+# every task. SparsePrefs keeps the ratings in a few numpy buffers that
+# the children never write to, so those pages stay shared.
+_prefs = None
+
+
+def _recommend_shard(args):
+    people, n = args
+    return [(person, personbased_recommend(_prefs, person, n=n)) for person in people]
+
+
+# Writes the top n personbased_recommend items of every person to output,
+# one tab separated line per person, as shards of shard_size people come
+# back from a pool of processes (default: one per core). Returns the
+# number of people written.
+def recommend_all(prefs, output, n=10, processes=None, shard_size=20, people=None):
+    global _prefs
+    if not hasattr(prefs, 'similarity_block'):
+        prefs = sparse_prefs(prefs)
+    people = sorted(people or prefs)
+    shards = [(people[i:i + shard_size], n) for i in range(0, len(people), shard_size)]
+
+    _prefs = prefs
+    pool = multiprocessing.Pool(processes)
+    done = 0
+    start = time.time()
+    try:
+        with open(output, 'w') as out:
+            for results in pool.imap_unordered(_recommend_shard, shards):
+                for person, items in results:
+                    out.write('\t'.join([str(person)] + items) + '\n')
+                done += len(results)
+                elapsed = time.time() - start
+                print '%d / %d users, %.1f users/s' % (done, len(people), done / max(elapsed, 1e-9))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _prefs = None
+    return done
+
+
+if __name__ == '__main__':
+    # python batch.py recommendations.tsv [n] [processes]
+    output = sys.argv[1] if len(sys.argv) > 1 else 'recommendations.tsv'
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    recommend_all(load_movielens(), output, n=n, processes=processes)
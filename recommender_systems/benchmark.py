@@ -0,0 +1,238 @@
+import argparse
+import json
+import multiprocessing
+import Queue
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy
+
+from recommendations import critics, sim_pearson, top_matches, get_recommendations, \
+    calculate_similar_items
+from sparseprefs import sparse_prefs
+from util import load_movielens, DATA_DIR
+
+SEED = 0
+
+DATASETS = ['critics', 'ml-latest-small', 'synthetic-1m']
+
+# Timed calls per case; the bigger the dataset the fewer
+SAMPLES = {'critics': 200, 'ml-latest-small': 30, 'synthetic-1m': 5}
+
+# Seconds a case may take before its process is killed
+TIMEOUT = 1800
+
+
+# Writes a MovieLens-shaped ratings.csv and movies.csv with Zipf-like
+# movie popularity, always the same files for the same seed
+def synthetic_movielens(path, ratings=1000000, users=10000, movies=5000, seed=SEED):
+    random_state = np.random.RandomState(seed)
+    popularity = 1.0 / np.arange(1, movies + 1)
+    user_ids = random_state.randint(1, users + 1, ratings)
+    movie_ids = random_state.choice(movies, ratings, p=popularity / popularity.sum()) + 1
+    # One rating per (user, movie) like the real dumps
+    pairs = np.unique(user_ids.astype(np.int64) * (movies + 1) + movie_ids)
+    user_ids, movie_ids = pairs // (movies + 1), pairs % (movies + 1)
+    scores = random_state.randint(1, 11, len(pairs)) / 2.0
+    timestamps = random_state.randint(828124615, 1476640644, len(pairs))
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    with open(os.path.join(path, 'ratings.csv'), 'w') as out:
+        out.write('userId,movieId,rating,timestamp\n')
+        for row in zip(user_ids, movie_ids, scores, timestamps):
+            out.write('%d,%d,%.1f,%d\n' % row)
+    with open(os.path.join(path, 'movies.csv'), 'w') as out:
+        out.write('movieId,title,genres\n')
+        for movie in range(1, movies + 1):
+            out.write('%d,Movie %d (2000),Drama\n' % (movie, movie))
+
+
+def sim_pearson_calls(prefs, rand, samples):
+    people = sorted(prefs)
+    pairs = [(rand.choice(people), rand.choice(people)) for i in range(10 * samples)]
+    return [lambda a=a, b=b: sim_pearson(prefs, a, b) for a, b in pairs]
+
+
+def person_calls(function):
+    def calls(prefs, rand, samples):
+        people = sorted(prefs)
+        return [lambda person=rand.choice(people): function(prefs, person) for i in range(samples)]
+    return calls
+
+
+def similar_items_calls(prefs, rand, samples):
+    return [lambda: calculate_similar_items(prefs, n=10)]
+
+
+# (function, backend, datasets, calls(prefs, rand, samples)) per case.
+# The dict calculate_similar_items compares every pair of movies, so it
+# only runs on critics.
+CASES = [
+    ('sim_pearson', 'dict', DATASETS, sim_pearson_calls),
+    ('top_matches', 'dict', DATASETS, person_calls(top_matches)),
+    ('top_matches', 'sparse', DATASETS, person_calls(top_matches)),
+    ('get_recommendations', 'dict', DATASETS, person_calls(get_recommendations)),
+    ('get_recommendations', 'sparse', DATASETS, person_calls(get_recommendations)),
+    ('calculate_similar_items', 'dict', ['critics'], similar_items_calls),
+    ('calculate_similar_items', 'sparse', ['critics', 'ml-latest-small'], similar_items_calls),
+]
+
+
+def percentile(sorted_samples, q):
+    return sorted_samples[min(len(sorted_samples) - 1, int(q * len(sorted_samples)))]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {'calls': len(latencies),
+            'mean_ms': 1000 * total / len(latencies),
+            'p50_ms': 1000 * percentile(latencies, 0.50),
+            'p90_ms': 1000 * percentile(latencies, 0.90),
+            'p99_ms': 1000 * percentile(latencies, 0.99),
+            'throughput_per_s': len(latencies) / total if total else None}
+
+
+def _measure(setup, queue):
+    # Status prints of the timed code must not end up in the JSON
+    sys.stdout = sys.stderr
+    try:
+        calls = setup()
+        latencies = []
+        for call in calls:
+            start = time.time()
+            call()
+            latencies.append(time.time() - start)
+        result = summarize(latencies)
+        result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put(result)
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+
+# Runs setup() and then times each call it returns in a forked process,
+# so the peak RSS reported belongs to that case alone. A process that
+# dies without a result (killed for memory, a crash in numpy) or runs
+# past timeout seconds gives an error result instead of hanging the run.
+def isolated(setup, timeout=TIMEOUT):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(setup, queue))
+    process.start()
+    deadline = time.time() + timeout
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Queue.Empty:
+            if process.exitcode is not None:
+                # The result may still be in the pipe when the process exits
+                try:
+                    result = queue.get(timeout=1)
+                except Queue.Empty:
+                    result = {'error': 'process exited with code %d' % process.exitcode}
+            elif time.time() > deadline:
+                process.terminate()
+                result = {'error': 'timed out after %d s' % timeout}
+    process.join()
+    return result
+
+
+def run(datasets, paths, timeout=TIMEOUT):
+    results = []
+    for dataset in datasets:
+        def load(dataset=dataset):
+            if dataset == 'critics':
+                return critics
+            return load_movielens(paths[dataset])
+
+        for function, backend, supported, make_calls in CASES:
+            if dataset not in supported:
+                continue
+            print >> sys.stderr, 'benchmarking %s (%s) on %s' % (function, backend, dataset)
+
+            def setup(load=load, backend=backend, make_calls=make_calls, samples=SAMPLES[dataset]):
+                prefs = load()
+                if backend == 'sparse':
+                    prefs = sparse_prefs(prefs)
+                return make_calls(prefs, random.Random(SEED), samples)
+            result = isolated(setup, timeout)
+            result.update({'dataset': dataset, 'function': function, 'backend': backend})
+            results.append(result)
+
+        if dataset in paths:
+            print >> sys.stderr, 'benchmarking load_movielens on %s' % dataset
+            result = isolated(lambda path=paths[dataset]: [lambda: load_movielens(path)] * 3, timeout)
+            result.update({'dataset': dataset, 'function': 'load_movielens', 'backend': 'dict'})
+            results.append(result)
+    return results
+
+
+# Prints cases whose p50 latency grew by more than threshold (0.2 = 20%)
+# between two benchmark JSON files; returns how many did
+def compare(old_report, new_report, threshold=0.2):
+    def by_case(report):
+        return dict(((r['dataset'], r['function'], r['backend']), r)
+                    for r in report['results'] if 'error' not in r)
+    old, new = by_case(old_report), by_case(new_report)
+    regressions = 0
+    for case in sorted(set(old) & set(new)):
+        ratio = new[case]['p50_ms'] / max(old[case]['p50_ms'], 1e-9)
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print >> sys.stderr, '%-16s %-24s %-7s %10.3f -> %10.3f ms  x%.2f%s' % (
+            case + (old[case]['p50_ms'], new[case]['p50_ms'], ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark recommender_systems functions')
+    parser.add_argument('--datasets', default=','.join(DATASETS),
+                        help='comma separated subset of %s' % ', '.join(DATASETS))
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='earlier JSON report to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--timeout', type=float, default=TIMEOUT,
+                        help='seconds a case may run before it is killed')
+    args = parser.parse_args(argv)
+
+    datasets = args.datasets.split(',')
+    paths = {'ml-latest-small': os.path.join(DATA_DIR, 'ratings.csv')}
+    workdir = None
+    if 'synthetic-1m' in datasets:
+        workdir = tempfile.mkdtemp()
+        synthetic_movielens(workdir)
+        paths['synthetic-1m'] = os.path.join(workdir, 'ratings.csv')
+    try:
+        results = run(datasets, paths, args.timeout)
+    finally:
+        if workdir is not None:
+            shutil.rmtree(workdir)
+
+    report = {'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                              'scipy': scipy.__version__, 'seed': SEED},
+              'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(text + '\n')
+    else:
+        print text
+
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(json.load(f), report, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
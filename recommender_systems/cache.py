@@ -0,0 +1,115 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from recommendations import sim_pearson, get_recommendations, get_recommended_items
+
+
+# LRU cache (with an optional time to live in seconds) in front of
+# get_recommendations and get_recommended_items, holding at most
+# max_entries result lists keyed by (user, algorithm, similarity, n).
+# Item-based lists are keyed by the id of their item_match table, which
+# the entry keeps alive so the id can't be reused by another table.
+# One cache serves one prefs dictionary (or SparsePrefs).
+#
+# Rating changes must go through set_rating (or be followed by
+# invalidate): a person-based list depends on everyone sharing an item
+# with the user, so those entries are dropped too. Item-based lists only
+# depend on the user's own ratings and the item_match table; call clear()
+# when the table is rebuilt.
+class RecommendationCache:
+    def __init__(self, max_entries=10000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # user -> keys of their entries, so invalidate doesn't scan them all
+        self.users = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _lookup(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None or (entry[0] is not None and entry[0] < time.time()):
+            if entry is not None:
+                self._forget(key)
+            self.misses += 1
+            return None
+        # Move to the most recently used end
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def _store(self, key, result, table=None):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        self.entries[key] = (expires, result, table)
+        self.users.setdefault(key[0], set()).add(key)
+        while len(self.entries) > self.max_entries:
+            old, entry = self.entries.popitem(last=False)
+            self._forget(old)
+            self.evictions += 1
+        return result
+
+    def _forget(self, key):
+        keys = self.users.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.users[key[0]]
+
+    def get_recommendations(self, prefs, person, similarity=sim_pearson, n=None):
+        key = (person, 'user', similarity.__name__, n)
+        result = self._lookup(key)
+        if result is None:
+            result = self._store(key, get_recommendations(prefs, person, similarity=similarity, n=n))
+        return list(result)
+
+    def get_recommended_items(self, prefs, item_match, user, n=None):
+        key = (user, 'item', id(item_match), n)
+        result = self._lookup(key)
+        if result is None:
+            result = self._store(key, get_recommended_items(prefs, item_match, user, n=n), item_match)
+        return list(result)
+
+    def _sharing(self, prefs, person):
+        # Cached users who rated one of person's items
+        if person not in prefs:
+            return set()
+        if hasattr(prefs, 'rated'):
+            shared = prefs.rated.dot(prefs.rated[prefs.person_index[person]].T).toarray().ravel()
+            return set(prefs.people[row] for row in np.flatnonzero(shared)) & set(self.users)
+        items = prefs[person]
+        return set(user for user in self.users if user in prefs and
+                   any(item in items for item in prefs[user]))
+
+    def invalidate(self, prefs, person):
+        # Drop person's entries and the person-based entries of everyone
+        # whose similarity to person depends on person's ratings
+        keys = set(self.users.get(person, ()))
+        for user in self._sharing(prefs, person):
+            keys.update(key for key in self.users[user] if key[1] == 'user')
+        for key in keys:
+            del self.entries[key]
+            self._forget(key)
+            self.invalidations += 1
+
+    def set_rating(self, prefs, person, item, rating):
+        if hasattr(prefs, 'set_rating'):
+            prefs.set_rating(person, item, rating)
+        else:
+            prefs.setdefault(person, {})[item] = rating
+        self.invalidate(prefs, person)
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.users.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'entries': len(self.entries), 'evictions': self.evictions,
+                'invalidations': self.invalidations}
@@ -0,0 +1,148 @@
+import random
+import time
+from math import sqrt
+
+import numpy as np
+
+from recommendations import sim_pearson, get_recommendations
+from sparseprefs import sparse_prefs
+from topk import top_k_indices
+from util import load_movielens
+
+
+# Latent factor model: a rating is predicted as the global mean plus the
+# dot product of a person vector and an item vector. Unlike the
+# neighbourhood methods it needs no prefs at query time, only the two
+# factor matrices (and the person's rated items to leave them out).
+class FactorModel:
+    def __init__(self, people, items, mean, user_factors, item_factors, rated):
+        self.people = people
+        self.items = items
+        self.mean = mean
+        self.user_factors = user_factors
+        self.item_factors = item_factors
+        self.rated = rated
+        self.person_index = dict((p, i) for i, p in enumerate(people))
+        self.item_index = dict((it, i) for i, it in enumerate(items))
+
+    def predict(self, person, item):
+        u = self.person_index.get(person)
+        i = self.item_index.get(item)
+        if u is None or i is None:
+            return self.mean
+        return self.mean + float(self.user_factors[u].dot(self.item_factors[i]))
+
+    # Top n (score, item) for person from one matrix-vector product,
+    # leaving out the items person has rated
+    def recommend(self, person, n=10):
+        u = self.person_index[person]
+        scores = self.item_factors.dot(self.user_factors[u]) + self.mean
+        start, end = self.rated.indptr[u], self.rated.indptr[u + 1]
+        scores[self.rated.indices[start:end]] = -np.inf
+        best = [i for i in top_k_indices(scores, n) if scores[i] > -np.inf]
+        return [(float(scores[i]), self.items[i]) for i in best]
+
+
+# Alternating least squares: with the item vectors fixed every person
+# vector is a small ridge regression over that person's ratings, and the
+# other way around. The penalty grows with the number of ratings
+# (weighted-lambda regularization).
+def train_als(prefs, factors=20, regularization=0.1, iterations=10, seed=0):
+    if not hasattr(prefs, 'similarity_block'):
+        prefs = sparse_prefs(prefs)
+    by_user = prefs.matrix
+    by_item = by_user.T.tocsr()
+    mean = by_user.data.mean() if by_user.nnz else 0.0
+
+    random_state = np.random.RandomState(seed)
+    user_factors = random_state.normal(0, 0.1, (by_user.shape[0], factors))
+    item_factors = random_state.normal(0, 0.1, (by_user.shape[1], factors))
+    eye = np.eye(factors)
+
+    def solve(ratings, fixed, target):
+        for row in range(ratings.shape[0]):
+            start, end = ratings.indptr[row], ratings.indptr[row + 1]
+            if start == end:
+                continue
+            other = fixed[ratings.indices[start:end]]
+            a = other.T.dot(other) + regularization * (end - start) * eye
+            b = other.T.dot(ratings.data[start:end] - mean)
+            target[row] = np.linalg.solve(a, b)
+
+    for i in range(iterations):
+        solve(by_user, item_factors, user_factors)
+        solve(by_item, user_factors, item_factors)
+    return FactorModel(prefs.people, prefs.items, mean, user_factors, item_factors, by_user)
+
+
+# FINAL METHOD FOR LATENT FACTOR RECOMMENDATIONS
+# Like personbased_recommend; without a model one is trained on prefs
+def factorbased_recommend(prefs, person, n=10, model=None):
+    if model is None:
+        model = train_als(prefs)
+    return [item for score, item in model.recommend(person, n=n)]
+
+
+# Splits prefs into a training dictionary and a list of held-out
+# (person, item, rating), keeping at least one rating per person
+def split_prefs(prefs, test_fraction=0.2, seed=0):
+    rand = random.Random(seed)
+    train = {}
+    test = []
+    for person in sorted(prefs):
+        ratings = sorted(prefs[person].items())
+        rand.shuffle(ratings)
+        held = int(len(ratings) * test_fraction)
+        train[person] = dict(ratings[held:])
+        test.extend((person, item, rating) for item, rating in ratings[0:held])
+    return train, test
+
+
+# Root mean squared error of predict(person, item) over the held out
+# (person, item, rating) triples
+def rmse(predict, test):
+    if not test:
+        raise ValueError('rmse of an empty test set')
+    errors = [pow(predict(person, item) - rating, 2) for person, item, rating in test]
+    return sqrt(sum(errors) / len(errors))
+
+
+# Rating predictions of get_recommendations, falling back to the
+# person's mean rating when no similar person rated the item
+def neighbourhood_predictor(train, similarity=sim_pearson):
+    if not hasattr(train, 'similarity_block'):
+        train = sparse_prefs(train)
+    predictions = {}
+
+    def predict(person, item):
+        if person not in predictions:
+            ratings = train[person].values()
+            predictions[person] = (dict((it, score) for score, it in
+                                        get_recommendations(train, person, similarity=similarity)),
+                                   sum(ratings) / len(ratings))
+        scores, person_mean = predictions[person]
+        return scores.get(item, person_mean)
+    return predict
+
+
+# Held-out RMSE and time of the latent factor model and of
+# get_recommendations on the same split
+def compare(prefs, test_fraction=0.2, seed=0, **als_options):
+    train, test = split_prefs(prefs, test_fraction, seed)
+    results = {}
+
+    start = time.time()
+    model = train_als(train, seed=seed, **als_options)
+    trained = time.time()
+    results['als'] = {'rmse': rmse(model.predict, test), 'train_seconds': trained - start,
+                      'predict_seconds': time.time() - trained}
+
+    start = time.time()
+    results['neighbourhood'] = {'rmse': rmse(neighbourhood_predictor(train), test),
+                                'predict_seconds': time.time() - start}
+    return results
+
+
+if __name__ == '__main__':
+    for name, result in sorted(compare(load_movielens()).items()):
+        print name, ', '.join('%s: %.4f' % item for item in sorted(result.items()))
@@ -0,0 +1,125 @@
+import heapq
+from math import sqrt
+
+from recommendations import sim_pearson, sim_distance
+
+
+# Sufficient statistics for a pair of items a < b, summed over the users
+# who rated both: the numbers sim_pearson and sim_distance need.
+N, SUM_A, SUM_B, SQ_A, SQ_B, P_SUM = range(6)
+
+
+def pair_similarity(stats, similarity=sim_distance):
+    n = stats[N]
+    if n == 0:
+        return 0
+    if similarity is sim_distance:
+        sum_of_squares = stats[SQ_A] + stats[SQ_B] - 2 * stats[P_SUM]
+        return 1 / (1 + max(sum_of_squares, 0))
+    if similarity is sim_pearson:
+        num = stats[P_SUM] - (stats[SUM_A] * stats[SUM_B] / n)
+        den = (stats[SQ_A] - pow(stats[SUM_A], 2) / n) * (stats[SQ_B] - pow(stats[SUM_B], 2) / n)
+        if den <= 0:
+            return 0
+        return num / sqrt(den)
+    raise ValueError('No pair statistics for %r' % similarity)
+
+
+# Item-neighbour table that follows a stream of ratings.
+# It keeps the pair statistics of every two co-rated items and the n best
+# (score, item2) pairs per item, the same lists calculate_similar_items
+# builds except that items without a shared rater are left out.
+#
+# add_rating touches one statistics entry per item in the user's history
+# and only the neighbour lists of those items. A list whose member got
+# worse may have been overtaken by an unlisted item; it is marked stale
+# and rebuilt from its pair statistics the next time it is read.
+#
+# The ratings of prefs are copied into self.prefs, which add_rating keeps
+# up to date; the caller's prefs are not changed.
+class IncrementalItemSimilarity:
+    def __init__(self, prefs, n=10, similarity=sim_distance):
+        self.prefs = {}
+        self.n = n
+        self.similarity = similarity
+        self.pairs = {}
+        self.lists = {}
+        self.stale = set()
+        for user in prefs:
+            for item, rating in prefs[user].items():
+                self.add_rating(user, item, rating)
+
+    def add_rating(self, user, item, rating):
+        history = self.prefs.setdefault(user, {})
+        old = history.get(item)
+        self.lists.setdefault(item, [])
+        for other, other_rating in history.items():
+            if other == item:
+                continue
+            stats = self._pair(item, other)
+            if item < other:
+                s, sq, s_other, sq_other = SUM_A, SQ_A, SUM_B, SQ_B
+            else:
+                s, sq, s_other, sq_other = SUM_B, SQ_B, SUM_A, SQ_A
+            if old is None:
+                stats[N] += 1
+                stats[s] += rating
+                stats[sq] += rating * rating
+                stats[s_other] += other_rating
+                stats[sq_other] += other_rating * other_rating
+                stats[P_SUM] += rating * other_rating
+            else:
+                stats[s] += rating - old
+                stats[sq] += rating * rating - old * old
+                stats[P_SUM] += (rating - old) * other_rating
+
+            score = pair_similarity(stats, self.similarity)
+            self._offer(item, other, score)
+            self._offer(other, item, score)
+        history[item] = rating
+
+    def _pair(self, item1, item2):
+        stats = self.pairs.setdefault(item1, {}).get(item2)
+        if stats is None:
+            stats = [0, 0.0, 0.0, 0.0, 0.0, 0.0]
+            # Both directions share one entry
+            self.pairs[item1][item2] = stats
+            self.pairs.setdefault(item2, {})[item1] = stats
+        return stats
+
+    def _offer(self, item, other, score):
+        if item in self.stale:
+            return
+        best = self.lists.setdefault(item, [])
+        listed = [entry for entry in best if entry[1] != other]
+        if len(listed) < len(best) and len(best) == self.n and (score, other) < best[-1] \
+                and len(self.pairs[item]) > self.n:
+            # A listed item dropped below the cut-off
+            self.stale.add(item)
+            return
+        listed.append((score, other))
+        listed.sort(reverse=True)
+        self.lists[item] = listed[0:self.n]
+
+    def _rebuild(self, item):
+        self.lists[item] = heapq.nlargest(
+            self.n, [(pair_similarity(stats, self.similarity), other)
+                     for other, stats in self.pairs.get(item, {}).items()])
+        self.stale.discard(item)
+
+    def __getitem__(self, item):
+        if item in self.stale:
+            self._rebuild(item)
+        return self.lists[item]
+
+    def __iter__(self):
+        return iter(self.lists)
+
+    def __len__(self):
+        return len(self.lists)
+
+    def __contains__(self, item):
+        return item in self.lists
+
+    def keys(self):
+        return self.lists.keys()
@@ -0,0 +1,81 @@
+import os
+import cPickle as pickle
+
+import numpy as np
+
+from recommendations import sim_distance
+from sparseprefs import sparse_prefs
+from topk import top_k_indices
+from util import save_arrays, load_arrays
+
+
+# Item-neighbour table: row i holds the ids and scores of the n items most
+# similar to items[i], best first, padded with -1 when there are fewer.
+# It reads like the dictionary calculate_similar_items returns
+# (item_match[item] -> [(score, item2), ...]) so get_recommended_items
+# can use it as is.
+class ItemSimilarity:
+    def __init__(self, items, neighbours, scores):
+        self.items = items
+        self.neighbours = neighbours
+        self.scores = scores
+        self.item_index = dict((it, i) for i, it in enumerate(items))
+
+    def __getitem__(self, item):
+        row = self.item_index[item]
+        return [(float(score), self.items[j]) for j, score in
+                zip(self.neighbours[row], self.scores[row]) if j >= 0]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.item_index
+
+    def keys(self):
+        return list(self.items)
+
+    def save(self, path):
+        save_arrays(path, neighbours=self.neighbours, scores=self.scores)
+        with open(os.path.join(path, 'items.pickle'), 'wb') as f:
+            pickle.dump(self.items, f, pickle.HIGHEST_PROTOCOL)
+
+
+# Computes the same table as calculate_similar_items(prefs, n) but from
+# SparsePrefs similarity blocks of block_size items at a time
+def build_item_similarity(prefs, n=10, similarity=sim_distance, block_size=256):
+    if not hasattr(prefs, 'similarity_block'):
+        prefs = sparse_prefs(prefs)
+    item_prefs = prefs.transpose()
+    count = len(item_prefs)
+
+    neighbours = np.empty((count, n), dtype=np.int32)
+    neighbours.fill(-1)
+    scores = np.zeros((count, n), dtype=np.float64)
+    for start in range(0, count, block_size):
+        # Status updates for large datasets
+        print "%d / %d" % (start, count)
+        rows = range(start, min(start + block_size, count))
+        block = item_prefs.similarity_block(rows, similarity)
+        for i, row in enumerate(rows):
+            best = top_k_indices(block[i], n, exclude=row)
+            neighbours[row, 0:len(best)] = best
+            scores[row, 0:len(best)] = block[i, best]
+    return ItemSimilarity(item_prefs.people, neighbours, scores)
+
+
+_loaded = {}
+
+
+# Opens a table saved with ItemSimilarity.save. The arrays are
+# memory-mapped and every path is opened only once per process.
+def load_item_similarity(path):
+    if path not in _loaded:
+        neighbours, scores = load_arrays(path, ['neighbours', 'scores'])
+        with open(os.path.join(path, 'items.pickle'), 'rb') as f:
+            items = pickle.load(f)
+        _loaded[path] = ItemSimilarity(items, neighbours, scores)
+    return _loaded[path]
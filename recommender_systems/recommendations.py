@@ -1,4 +1,5 @@
 from math import sqrt
+from topk import top_k
 from pydelicious import get_popular, get_userposts, get_urlposts
 
 # A dictionary of movie critics and their ratings of a small
@@ -76,18 +77,25 @@ def sim_pearson(prefs, person1, person2):
 
 # Returns the best matches for person from the prefs dictionary.
 # Number of results and similarity function are optional params.
-def top_matches(prefs, person, n=5, similarity=sim_pearson):
-    scores = [(similarity(prefs, person, other), other)
-              for other in prefs if other != person]
-    # Sort the list so the highest scores appear at the top
-    scores.sort()
-    scores.reverse()
-    return scores[0:n]
+# An annindex.CoRatingIndex built over prefs narrows the search down
+# to its candidates, scoring `share` of the people (its default if None).
+def top_matches(prefs, person, n=5, similarity=sim_pearson, index=None, share=None):
+    if index is not None:
+        return index.top_matches(prefs, person, n=n, similarity=similarity, share=share)
+    # Matrix backed prefs (see sparseprefs.py) score everyone at once
+    if hasattr(prefs, 'top_matches'):
+        return prefs.top_matches(person, n=n, similarity=similarity)
+    scores = ((similarity(prefs, person, other), other)
+              for other in prefs if other != person)
+    # Keep only the n highest scores, best first
+    return top_k(scores, n)
 
 
 # Gets recommendations for a person by using a weighted average
-# of every other user's rankings
-def get_recommendations(prefs, person, similarity=sim_pearson):
+# of every other user's rankings (only the best n if n is given)
+def get_recommendations(prefs, person, similarity=sim_pearson, n=None):
+    if hasattr(prefs, 'get_recommendations'):
+        return prefs.get_recommendations(person, similarity=similarity, n=n)
     totals = {}
     simSums = {}
     for other in prefs:
@@ -110,12 +118,10 @@ def get_recommendations(prefs, person, similarity=sim_pearson):
                 simSums[item] += sim
 
     # Create normalized list
-    rankings = [(total / simSums[item], item) for item, total in totals.items()]
+    rankings = ((total / simSums[item], item) for item, total in totals.items())
 
     # Return the sorted list
-    rankings.sort()
-    rankings.reverse()
-    return rankings
+    return top_k(rankings, n)
 
 
 """
@@ -128,6 +134,8 @@ Collective Intelligence str.18
 
 
 def transform_prefs(prefs):
+    if hasattr(prefs, 'transpose'):
+        return prefs.transpose()
     result = {}
     for person in prefs:
         for item in prefs[person]:
@@ -157,7 +165,11 @@ def calculate_similar_items(prefs, n=10):
     return result
 
 
-def get_recommended_items(prefs, item_match, user):
+def get_recommended_items(prefs, item_match, user, n=None):
+    # item_match can also be the path of a table saved by itemsim.py
+    if isinstance(item_match, basestring):
+        from itemsim import load_item_similarity
+        item_match = load_item_similarity(item_match)
     user_ratings = prefs[user]
     scores = {}
     total_sim = {}
@@ -181,12 +193,10 @@ def get_recommended_items(prefs, item_match, user):
             total_sim[item2] += similarity
 
     # Divide each total score  by total wighting to get an average
-    rankings = [(score / total_sim[item], item) for item, score in scores.items()]
+    rankings = ((score / total_sim[item], item) for item, score in scores.items())
 
     # Return the rankings from highest to lowest
-    rankings.sort()
-    rankings.reverse()
-    return rankings
+    return top_k(rankings, n)
 
 
 """
@@ -211,16 +221,20 @@ def load_movie_lens(path='/data/movielens'):
 # FINAL METHOD FOR PERSON BASED RECOMMENDATIONS
 # Gets top n movie titles for one person (id)
 def personbased_recommend(prefs, person, n=10):
-    t_list = get_recommendations(prefs, person)
-    mov = [movies for coef, movies in t_list]
-    return mov[0:n]
+    t_list = get_recommendations(prefs, person, n=n)
+    return [movies for coef, movies in t_list]
 
 
 # FINAL METHOD FOR ITEM (MOVIE) BASED RECOMMENDATION
-def itembased_reccomend(prefs, person, n=10):
-    itemsim = calculate_similar_items(prefs, n=n)
-    itms = get_recommended_items(prefs, itemsim, person)
-    rec = [items for coef, items in itms]
-    return rec[0:10]
+# item_match is a precomputed item-neighbour table (a dict, an
+# itemsim.ItemSimilarity or the path of a saved one); without it
+# the table is recalculated on every call.
+def itembased_reccomend(prefs, person, n=10, item_match=None):
+    if item_match is None:
+        itemsim = calculate_similar_items(prefs, n=n)
+    else:
+        itemsim = item_match
+    itms = get_recommended_items(prefs, itemsim, person, n=10)
+    return [items for coef, items in itms]
 
 #TODO odraditi povezivanje sa bazom i skladistenje koeficijenata u bazi, kasnije i profili, kasnije i web
\ No newline at end of file
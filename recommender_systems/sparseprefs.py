@@ -0,0 +1,211 @@
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix
+
+from recommendations import sim_pearson, sim_distance
+from topk import top_k_indices
+
+
+# Packs a prefs dictionary into a CSR person x item matrix with integer
+# id maps so that one person can be compared with everybody else in a
+# handful of sparse products instead of a Python loop per pair.
+#
+# Rows and columns are kept in sorted key order, so an index doubles as
+# the tie-breaking key for topk.top_k_indices.
+#
+# The object still behaves like the prefs dictionary (prefs[person],
+# iteration, len, in), so every function in recommendations.py accepts
+# it; top_matches, get_recommendations and transform_prefs hand the work
+# over to the vectorized methods below.
+class SparsePrefs:
+    # Similarity functions with a batch version in similarity_block
+    vectorized = (sim_pearson, sim_distance)
+
+    def __init__(self, matrix, people, items):
+        self.matrix = csr_matrix(matrix, dtype=np.float64)
+        self.people = list(people)
+        self.items = list(items)
+        self.person_index = dict((p, i) for i, p in enumerate(self.people))
+        self.item_index = dict((it, i) for i, it in enumerate(self.items))
+
+        # Same sparsity structure, so ratings of 0 still count as rated
+        shape = self.matrix.shape
+        structure = (self.matrix.indices, self.matrix.indptr)
+        self.rated = csr_matrix((np.ones(self.matrix.nnz), ) + structure, shape=shape)
+        self.squares = csr_matrix((self.matrix.data ** 2, ) + structure, shape=shape)
+
+        # Transposes are reused by every similarity_block call. A CSR
+        # matrix read as CSC is its transpose, so they are views of the
+        # same arrays and set_rating only has to change the data once.
+        self._matrix_t = csc_matrix((self.matrix.data, ) + structure, shape=shape[::-1])
+        self._rated_t = csc_matrix((self.rated.data, ) + structure, shape=shape[::-1])
+        self._squares_t = csc_matrix((self.squares.data, ) + structure, shape=shape[::-1])
+
+    def __getitem__(self, person):
+        row = self.person_index[person]
+        start, end = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+        return dict((self.items[col], float(rating)) for col, rating in
+                    zip(self.matrix.indices[start:end], self.matrix.data[start:end]))
+
+    def __iter__(self):
+        return iter(self.people)
+
+    def __len__(self):
+        return len(self.people)
+
+    def __contains__(self, person):
+        return person in self.person_index
+
+    def keys(self):
+        return list(self.people)
+
+    def similarity_block(self, rows, similarity=sim_pearson, cols=None):
+        # Dense len(rows) x people matrix of similarity scores, or
+        # len(rows) x len(cols) when only some people are compared.
+        # The sums are the ones sim_pearson and sim_distance build over
+        # the shared items, computed for all pairs at once.
+        matrix_t, rated_t, squares_t = self._matrix_t, self._rated_t, self._squares_t
+        if cols is not None:
+            matrix_t, rated_t, squares_t = matrix_t[:, cols], rated_t[:, cols], squares_t[:, cols]
+        rated = self.rated[rows]
+        ratings = self.matrix[rows]
+        n = rated.dot(rated_t).toarray()
+        p_sum = ratings.dot(matrix_t).toarray()
+        sum1_sq = self.squares[rows].dot(rated_t).toarray()
+        sum2_sq = rated.dot(squares_t).toarray()
+
+        sum1 = sum2 = None
+        if similarity is sim_pearson:
+            sum1 = ratings.dot(rated_t).toarray()
+            sum2 = rated.dot(matrix_t).toarray()
+        return self._scores(similarity, n, p_sum, sum1, sum2, sum1_sq, sum2_sq)
+
+    def similarity_to(self, row, cols, similarity=sim_pearson):
+        # Scores of one person (row) against just the people cols, the
+        # same as similarity_block([row], similarity, cols)[0]. The sums
+        # come straight from the CSR arrays of those people's rows
+        # instead of sparse products, which cost a few milliseconds
+        # each however few people are compared.
+        cols = np.asarray(cols, dtype=np.int64)
+        start, end = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+        mine = np.zeros(len(self.items))
+        mine[self.matrix.indices[start:end]] = self.matrix.data[start:end]
+        shared = np.zeros(len(self.items))
+        shared[self.matrix.indices[start:end]] = 1
+
+        starts, ends = self.matrix.indptr[cols], self.matrix.indptr[cols + 1]
+        counts = ends - starts
+        total = counts.sum()
+        entries = np.arange(total) + np.repeat(starts - np.cumsum(counts) + counts, counts)
+        owner = np.repeat(np.arange(len(cols)), counts)
+        items, theirs = self.matrix.indices[entries], self.matrix.data[entries]
+        both = shared[items]
+        own = mine[items]
+
+        def per_person(values):
+            return np.bincount(owner, values, minlength=len(cols))[np.newaxis]
+        return self._scores(similarity, per_person(both), per_person(own * theirs),
+                            per_person(own), per_person(theirs * both),
+                            per_person(own ** 2), per_person(theirs ** 2 * both))[0]
+
+    def _scores(self, similarity, n, p_sum, sum1, sum2, sum1_sq, sum2_sq):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if similarity is sim_distance:
+                sum_of_squares = np.maximum(sum1_sq + sum2_sq - 2 * p_sum, 0)
+                scores = 1 / (1 + sum_of_squares)
+            elif similarity is sim_pearson:
+                num = p_sum - (sum1 * sum2 / n)
+                den = (sum1_sq - sum1 ** 2 / n) * (sum2_sq - sum2 ** 2 / n)
+                scores = num / np.sqrt(den)
+                scores[~(den > 0)] = 0
+            else:
+                raise ValueError('No vectorized version of %r' % similarity)
+        # No ratings in common
+        scores[n == 0] = 0
+        return scores
+
+    def similarities(self, person, similarity=sim_pearson):
+        # One-vs-all scores for person, indexed like self.people.
+        # Unknown similarity functions fall back to the dict version.
+        if similarity in self.vectorized:
+            return self.similarity_block([self.person_index[person]], similarity)[0]
+        return np.array([similarity(self, person, other) for other in self.people],
+                        dtype=np.float64)
+
+    def top_matches(self, person, n=5, similarity=sim_pearson):
+        scores = self.similarities(person, similarity)
+        best = top_k_indices(scores, n, exclude=self.person_index[person])
+        return [(float(scores[i]), self.people[i]) for i in best]
+
+    def get_recommendations(self, person, similarity=sim_pearson, n=None):
+        row = self.person_index[person]
+        sims = self.similarities(person, similarity)
+        sims[row] = 0
+        # ignore scores of zero and lower
+        sims[sims <= 0] = 0
+
+        totals = self._matrix_t.dot(sims)
+        sim_sums = self._rated_t.dot(sims)
+
+        # only score movies I haven't seen (or rated 0)
+        candidates = sim_sums > 0
+        start, end = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+        seen = self.matrix.indices[start:end][self.matrix.data[start:end] != 0]
+        candidates[seen] = False
+
+        items = np.flatnonzero(candidates)
+        rankings = totals[items] / sim_sums[items]
+        best = top_k_indices(rankings, n)
+        return [(float(rankings[i]), self.items[items[i]]) for i in best]
+
+    def transpose(self):
+        # Item-centric view, the matrix counterpart of transform_prefs
+        return SparsePrefs(self.matrix.T, self.items, self.people)
+
+    def set_rating(self, person, item, rating):
+        # prefs[person][item] = rating for the matrix. Changing a rating
+        # writes it into the data arrays of matrix and squares (and so of
+        # their transposes) in place, O(ratings of the person); a new
+        # rating, person or item is put at its sorted place and the
+        # matrices are rebuilt, which costs O(ratings).
+        if person in self.person_index and item in self.item_index:
+            row, col = self.person_index[person], self.item_index[item]
+            start, end = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+            found = np.flatnonzero(self.matrix.indices[start:end] == col)
+            if len(found):
+                self.matrix.data[start + found[0]] = rating
+                self.squares.data[start + found[0]] = rating ** 2
+                return
+        people = sorted(set(self.people) | set([person]))
+        items = sorted(set(self.items) | set([item]))
+        rows = np.searchsorted(people, self.people)
+        cols = np.searchsorted(items, self.items)
+        coo = self.matrix.tocoo()
+        rows, cols = rows[coo.row], cols[coo.col]
+        row, col = people.index(person), items.index(item)
+        keep = ~((rows == row) & (cols == col))
+        matrix = csr_matrix((np.append(coo.data[keep], rating),
+                             (np.append(rows[keep], row), np.append(cols[keep], col))),
+                            shape=(len(people), len(items)))
+        self.__init__(matrix, people, items)
+
+
+# Builds SparsePrefs from a {person: {item: rating}} dictionary
+def sparse_prefs(prefs):
+    people = sorted(prefs)
+    items = sorted(set(item for person in prefs for item in prefs[person]))
+    item_index = dict((it, i) for i, it in enumerate(items))
+
+    indptr = [0]
+    indices = []
+    data = []
+    for person in people:
+        ratings = sorted((item_index[item], rating) for item, rating in prefs[person].items())
+        indices.extend(col for col, rating in ratings)
+        data.extend(rating for col, rating in ratings)
+        indptr.append(len(indices))
+
+    matrix = csr_matrix((np.array(data, dtype=np.float64),
+                         np.array(indices, dtype=np.int32),
+                         np.array(indptr, dtype=np.int32)),
+                        shape=(len(people), len(items)))
+    return SparsePrefs(matrix, people, items)
@@ -0,0 +1,34 @@
+import heapq
+
+import numpy as np
+
+# Partial top-k selection used wherever a ranking is cut to its first
+# entries. Both functions keep the order the code used to get from
+# sort() followed by reverse() on (score, key) tuples: highest score
+# first, and between equal scores the larger key first. search_engine
+# keeps its own copy of top_k_indices in search_engine/topk.py.
+
+
+# The k largest (score, key) pairs of a stream, best first, kept in a
+# bounded heap: O(N log k) and no full list. k=None ranks everything.
+def top_k(pairs, k):
+    if k is None:
+        return sorted(pairs, reverse=True)
+    return heapq.nlargest(k, pairs)
+
+
+# Indices of the k highest values of a score array, best first, where
+# the index plays the part of the key. argpartition finds the k-th best
+# score and only the entries reaching it are sorted. exclude drops one
+# index (a person from their own matches); k=None ranks everything.
+def top_k_indices(scores, k, exclude=None):
+    scores = np.asarray(scores, dtype=np.float64)
+    candidates = np.arange(len(scores))
+    if exclude is not None:
+        candidates = candidates[candidates != exclude]
+    if k is not None and 0 < k < len(candidates):
+        cut = len(candidates) - k
+        kth = scores[candidates[np.argpartition(scores[candidates], cut)[cut]]]
+        candidates = candidates[scores[candidates] >= kth]
+    order = np.lexsort((candidates, scores[candidates]))[::-1]
+    return candidates[order[0:k]]
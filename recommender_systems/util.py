@@ -1,29 +1,117 @@
+import csv
+import os
+import shutil
+
+import numpy as np
+
 from recommendations import *
 
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ml-latest-small')
+
 
 # vraca id:title dictionary za filmove
-def get_movie_titles(path='ml-latest-small/movies.csv'):
+# (csv modul, jer naslovi pod navodnicima mogu da sadrze zarez)
+def get_movie_titles(path=os.path.join(DATA_DIR, 'movies.csv')):
     movies = {}
-    data = open(path, 'r')
-    data.readline()
-    for line in data:
-        (id, title) = line.split(',')[0:2]
-        movies[id] = title
-    data.close()
+    with open(path, 'rb') as data:
+        reader = csv.reader(data)
+        reader.next()
+        for row in reader:
+            movies[row[0]] = row[1]
     return movies
 
 
+# Kolonski prikaz ratings.csv: int32 userId i movieId, float32 rating,
+# int64 timestamp. Person based dictionary se pravi tek na zahtev.
+class Ratings:
+    def __init__(self, users, movies, ratings, timestamps):
+        self.users = users
+        self.movies = movies
+        self.ratings = ratings
+        self.timestamps = timestamps
+
+    def __len__(self):
+        return len(self.users)
+
+    # stvara person based dictionary {userId: {item: rating}};
+    # sa titles={movieId: title} kljucevi su naslovi kao u load_movielens
+    def to_prefs(self, titles=None):
+        prefs = {}
+        order = np.argsort(self.users, kind='mergesort')
+        users = self.users[order]
+        movies = self.movies[order].tolist()
+        ratings = self.ratings[order].astype(np.float64).tolist()
+        if titles is None:
+            items = [str(movie) for movie in movies]
+        else:
+            items = [titles[str(movie)] for movie in movies]
+        if not len(users):
+            return prefs
+        # granice blokova svakog korisnika
+        bounds = np.flatnonzero(np.diff(users)) + 1
+        starts = [0] + bounds.tolist()
+        ends = bounds.tolist() + [len(users)]
+        for start, end in zip(starts, ends):
+            prefs.setdefault(str(users[start]), {}).update(zip(items[start:end], ratings[start:end]))
+        return prefs
+
+
+# Ucitava ratings.csv u Ratings, citajuci fajl u komadima od chunk_size
+# bajtova, pa i MovieLens 20M ne mora ceo da stane u memoriju kao tekst.
+# Ako je dat snapshot direktorijum, nizovi se cuvaju tamo i sledeci put
+# se samo memory-mapuju (dok god velicina i vreme izmene csv-a odgovaraju
+# onima zapisanim u snapshot-u).
+def load_ratings(path=os.path.join(DATA_DIR, 'ratings.csv'), snapshot=None, chunk_size=64 << 20):
+    names = ['users', 'movies', 'ratings', 'timestamps']
+    if snapshot is not None and snapshot_is_fresh(snapshot, path, names):
+        return Ratings(*load_arrays(snapshot, names))
+
+    columns = dict((name, []) for name in names)
+    with open(path, 'rb') as data:
+        data.readline()
+        while True:
+            chunk = data.read(chunk_size)
+            if not chunk:
+                break
+            # dopuni do kraja poslednjeg reda
+            chunk += data.readline()
+            values = np.fromstring(chunk.replace('\r', '').replace('\n', ',').strip(','), sep=',')
+            if len(values) % 4 != 0:
+                raise ValueError('%s is not a userId,movieId,rating,timestamp file' % path)
+            values = values.reshape(-1, 4)
+            columns['users'].append(values[:, 0].astype(np.int32))
+            columns['movies'].append(values[:, 1].astype(np.int32))
+            columns['ratings'].append(values[:, 2].astype(np.float32))
+            columns['timestamps'].append(values[:, 3].astype(np.int64))
+            del values
+
+    arrays = {}
+    for name, dtype in zip(names, [np.int32, np.int32, np.float32, np.int64]):
+        parts = columns.pop(name)
+        arrays[name] = np.concatenate(parts) if parts else np.zeros(0, dtype)
+    if snapshot is not None:
+        save_arrays(snapshot, source=source_stamp(path), **arrays)
+    return Ratings(*[arrays[name] for name in names])
+
+
+# velicina i vreme izmene fajla, po kojima se vidi da li je snapshot
+# napravljen bas od njega
+def source_stamp(path):
+    return np.array([os.path.getsize(path), os.path.getmtime(path)], dtype=np.float64)
+
+
+# True ako snapshot ima sve nizove i napravljen je od fajla kakav je sada
+def snapshot_is_fresh(snapshot, path, names):
+    files = [os.path.join(snapshot, name + '.npy') for name in names + ['source']]
+    if not all(os.path.isfile(f) for f in files):
+        return False
+    return np.array_equal(np.load(files[-1]), source_stamp(path))
+
+
 # stvara person based dictionary
-def load_movielens(path='ml-latest-small/ratings.csv'):
-    prefs = {}
-    data = open(path)
-    movies = get_movie_titles()
-    data.readline()
-    for line in data:
-        (userId, movieId, rating, timestamp) = line.split(',')
-        prefs.setdefault(userId, {})
-        prefs[userId][movies[movieId]] = float(rating)
-    return prefs
+def load_movielens(path=os.path.join(DATA_DIR, 'ratings.csv'), snapshot=None):
+    movies = get_movie_titles(os.path.join(os.path.dirname(path), 'movies.csv'))
+    return load_ratings(path, snapshot=snapshot).to_prefs(movies)
 
 
 # vraca title na osnovu id-a
@@ -31,4 +119,27 @@ def get_movie_by_id(identifier, movies):
     return movies[identifier]
 
 
+# cuva numpy nizove kao .npy fajlove u direktorijumu path,
+# tako da load_arrays moze da ih memory-mapuje. Nizovi se pisu u
+# privremeni direktorijum koji tek na kraju zamenjuje path, pa path
+# nikad ne ostaje poluupisan.
+def save_arrays(path, **arrays):
+    path = path.rstrip(os.sep)
+    temporary, old = path + '.tmp', path + '.old'
+    for leftover in (temporary, old):
+        if os.path.isdir(leftover):
+            shutil.rmtree(leftover)
+    os.makedirs(temporary)
+    for name, array in arrays.items():
+        np.save(os.path.join(temporary, name + '.npy'), array)
+    if os.path.isdir(path):
+        os.rename(path, old)
+    os.rename(temporary, path)
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+
 
+# ucitava nizove koje je sacuvao save_arrays; sa mmap_mode='r' se
+# podaci citaju sa diska tek kada zatrebaju
+def load_arrays(path, names, mmap_mode='r'):
+    return [np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in names]
@@ -0,0 +1,187 @@
+import os
+import shutil
+
+import numpy as np
+from pysqlite2 import dbapi2 as sqlite
+
+from querycache import index_generation
+
+ARRAYS = ['inbound', 'pagerank', 'length', 'title_offsets', 'title_words']
+
+
+class Features:
+    """
+    Query independent features of every url, in arrays indexed by urlid:
+    inbound (number of links to the url), pagerank, length (number of
+    indexed words) and the ids of the words in the url's title, which
+    for urlid u are title_words[title_offsets[u]:title_offsets[u + 1]].
+    """
+    def __init__(self, inbound, pagerank, length, title_offsets, title_words, version=None):
+        self.version = version
+        self.inbound = inbound
+        self.pagerank = pagerank
+        self.length = length
+        self.title_offsets = title_offsets
+        self.title_words = title_words
+
+    def __len__(self):
+        return len(self.inbound)
+
+    def covers(self, urlids):
+        """
+        :param urlids: sorted urlid array
+        :return: True if every url was there when the features were built
+        """
+        return not len(urlids) or urlids[-1] < len(self)
+
+    def title_matches(self, urlids, wordids):
+        """
+        :return: number of title words of every url that are in wordids
+        """
+        starts = self.title_offsets[urlids]
+        counts = self.title_offsets[urlids + 1] - starts
+        ends = np.cumsum(counts)
+        # Index of every title word of the urls in title_words, url after url
+        positions = np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - ends + counts, counts)
+        found = np.in1d(self.title_words[positions], wordids)
+        return np.bincount(np.repeat(np.arange(len(urlids)), counts)[found], minlength=len(urlids))
+
+
+def features_path(dbname):
+    """
+    :return: directory of the features of a database file, None for :memory:
+    """
+    if dbname == ':memory:':
+        return None
+    return dbname + '.features'
+
+
+def per_url(rows, size, dtype):
+    """
+    :return: array of the (urlid, value) rows indexed by urlid, 0 where missing
+    """
+    rows = np.array(rows, dtype=np.float64).reshape(-1, 2)
+    values = np.zeros(size, dtype=dtype)
+    values[rows[:, 0].astype(np.int64)] = rows[:, 1]
+    return values
+
+
+def create_features_table(conn):
+    """
+    staticfeatures holds the version of the features the database was
+    last committed with and the index generation that commit made.
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS staticfeatures(version, generation)')
+    if conn.execute('SELECT COUNT(*) FROM staticfeatures').fetchone()[0] == 0:
+        conn.execute('INSERT INTO staticfeatures VALUES (0, NULL)')
+
+
+def version_path(path, version):
+    return os.path.join(path, 'features-%06d' % version)
+
+
+def published_version(conn):
+    """
+    :return: version of the features if they describe the database as it
+        is now, None if they were never built or anything changed since
+    """
+    try:
+        row = conn.execute('SELECT version, generation FROM staticfeatures').fetchone()
+    except sqlite.OperationalError:
+        return None
+    if row is None or row[1] is None or row[1] != index_generation(conn):
+        return None
+    return row[0]
+
+
+def build_features(conn, path):
+    """
+    Computes the features of every url from the database and saves them
+    as .npy files in a new version directory of path, recording the
+    version in staticfeatures. Both become visible with the next commit,
+    which must be Crawler.dbcommit: the features are stamped with the
+    generation it makes, and any later commit makes them stale.
+    Directories are never changed, so Searchers that mapped an older
+    version keep reading it undisturbed (see remove_old_versions).
+
+    :param conn: database connection
+    :param path: directory for the features
+    :return: Features
+    """
+    size = (conn.execute('SELECT MAX(rowid) FROM urllist').fetchone()[0] or 0) + 1
+    inbound = per_url(conn.execute('SELECT toid, COUNT(*) FROM link GROUP BY toid').fetchall(),
+                      size, np.int64)
+    try:
+        scores = conn.execute('SELECT urlid, score FROM pagerank').fetchall()
+    except sqlite.OperationalError:
+        # calculate_pagerank never ran
+        scores = []
+    pagerank = per_url(scores, size, np.float64)
+    length = per_url(conn.execute('SELECT urlid, length FROM pagelength').fetchall(), size, np.int64)
+    try:
+        titles = conn.execute('SELECT urlid, wordid FROM titlewords ORDER BY urlid, wordid').fetchall()
+    except sqlite.OperationalError:
+        # Database from before titles were recorded
+        titles = []
+    titles = np.array(titles, dtype=np.int64).reshape(-1, 2)
+    title_offsets = np.concatenate([[0], np.cumsum(np.bincount(titles[:, 0], minlength=size))])
+    create_features_table(conn)
+    version = conn.execute('SELECT version FROM staticfeatures').fetchone()[0] + 1
+    features = Features(inbound, pagerank, length, title_offsets.astype(np.int64), titles[:, 1].copy(),
+                        version)
+
+    directory = version_path(path, version)
+    for leftover in (directory, directory + '.tmp'):
+        # From a build that was never committed
+        if os.path.exists(leftover):
+            shutil.rmtree(leftover)
+    os.makedirs(directory + '.tmp')
+    for name in ARRAYS:
+        np.save(os.path.join(directory + '.tmp', name + '.npy'), getattr(features, name))
+    os.rename(directory + '.tmp', directory)
+    conn.execute('UPDATE staticfeatures SET version = ?, generation = ?',
+                 (version, index_generation(conn) + 1))
+    return features
+
+
+def remove_old_versions(path, version):
+    """
+    Deletes everything in path but the given version, once it is committed.
+    """
+    keep = os.path.basename(version_path(path, version))
+    for name in os.listdir(path):
+        if name != keep:
+            filename = os.path.join(path, name)
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            else:
+                os.remove(filename)
+
+
+def load_features(conn, path, current=None):
+    """
+    Memory-maps the features saved by build_features, if they are
+    up to date with the database.
+
+    :param conn: database connection
+    :param path: directory of the features
+    :param current: Features loaded before, returned as they are while
+        they are still the published version
+    :return: Features or None if there are no up to date features
+    """
+    if path is None:
+        return None
+    for attempt in range(3):
+        version = published_version(conn)
+        if version is None:
+            return None
+        if current is not None and current.version == version:
+            return current
+        try:
+            return Features(*[np.load(os.path.join(version_path(path, version), name + '.npy'),
+                                      mmap_mode='r') for name in ARRAYS], version=version)
+        except IOError:
+            # A newer version was committed and this one removed after
+            # the version was read
+            if attempt == 2:
+                raise
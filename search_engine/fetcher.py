@@ -0,0 +1,141 @@
+import httplib
+import threading
+import time
+import Queue
+from urlparse import urlsplit, urljoin
+
+
+class HostLimiter:
+    """
+    Per-host politeness: at most per_host requests in flight to one host
+    and at least delay seconds between the starts of two of them.
+    """
+    def __init__(self, per_host=2, delay=0.0):
+        self.per_host = per_host
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.last_start = {}
+
+    def acquire(self, host):
+        with self.lock:
+            slot = self.slots.setdefault(host, threading.Semaphore(self.per_host))
+        slot.acquire()
+        if self.delay > 0:
+            with self.lock:
+                start = max(time.time(), self.last_start.get(host, 0) + self.delay)
+                self.last_start[host] = start
+            time.sleep(max(0, start - time.time()))
+
+    def release(self, host):
+        self.slots[host].release()
+
+
+class FetchPool:
+    """
+    Bounded pool of fetch threads feeding a result queue.
+
+    Urls go in with submit() and come out of results as
+    (url, level, html) tuples, html being None when the page
+    could not be fetched. Every thread keeps one open (keep-alive)
+    connection per host, so pages from the same site reuse it.
+    """
+    def __init__(self, workers=8, per_host=2, delay=0.0, timeout=10, max_redirects=5):
+        self.limiter = HostLimiter(per_host, delay)
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.frontier = Queue.Queue()
+        self.results = Queue.Queue()
+        self.local = threading.local()
+        self.threads = [threading.Thread(target=self.work) for i in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, url, level):
+        self.frontier.put((url, level))
+
+    def close(self):
+        """
+        Drops the urls still waiting and stops the fetch threads.
+        """
+        try:
+            while True:
+                self.frontier.get_nowait()
+        except Queue.Empty:
+            pass
+        for thread in self.threads:
+            self.frontier.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def work(self):
+        self.local.connections = {}
+        while True:
+            task = self.frontier.get()
+            if task is None:
+                break
+            url, level = task
+            try:
+                html = self.fetch(url)
+            except Exception:
+                html = None
+            self.results.put((url, level, html))
+        for conn in self.local.connections.values():
+            conn.close()
+
+    def connection(self, scheme, host):
+        """
+        Returns this thread's open connection to a host or creates it.
+
+        :param scheme: http or https
+        :param host: host[:port] part of the url
+        :return: httplib connection
+        """
+        conn = self.local.connections.get((scheme, host))
+        if conn is None:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(host, timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(host, timeout=self.timeout)
+            self.local.connections[(scheme, host)] = conn
+        return conn
+
+    def fetch(self, url):
+        """
+        Downloads a page, following redirects.
+
+        :param url: page url
+        :return: page body or None for non 2xx responses
+        """
+        for i in range(self.max_redirects + 1):
+            parts = urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            self.limiter.acquire(parts.netloc)
+            try:
+                response = self.request(parts.scheme, parts.netloc, path)
+                body = response.read()
+            finally:
+                self.limiter.release(parts.netloc)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('location'):
+                url = urljoin(url, response.getheader('location'))
+                continue
+            if 200 <= response.status < 300:
+                return body
+            return None
+        return None
+
+    def request(self, scheme, host, path):
+        conn = self.connection(scheme, host)
+        try:
+            conn.request('GET', path, headers={'Connection': 'keep-alive'})
+            return conn.getresponse()
+        except (httplib.HTTPException, IOError):
+            # The server closed the kept-alive connection, open a new one
+            conn.close()
+            del self.local.connections[(scheme, host)]
+            conn = self.connection(scheme, host)
+            conn.request('GET', path, headers={'Connection': 'keep-alive'})
+            return conn.getresponse()
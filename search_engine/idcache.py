@@ -0,0 +1,163 @@
+import os
+from collections import OrderedDict
+
+
+class IdCache:
+    """
+    Bounded, write-through value -> rowid cache for one column
+    (wordlist.word or urllist.url).
+
+    It holds no connection of its own: every call gets the caller's
+    connection, so lookups and inserts happen in the caller's thread and
+    transaction. New rows are inserted into the table first and go into
+    the caller's pending dict, not the cache: until the transaction
+    commits their rowids are only valid in it, and a rollback lets SQLite
+    hand them out again. The caller publishes them with commit() after
+    its own commit, or drops them with rollback(). Values that are not in
+    the table are not cached, another writer may add them later. The
+    least recently used entries are evicted beyond max_size. The first
+    lookup warm-loads up to max_size rows from the table.
+    """
+    def __init__(self, table, field, max_size=1000000):
+        self.table = table
+        self.field = field
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def warm_load(self, conn):
+        cursor = conn.execute(
+            'SELECT %s, rowid FROM %s LIMIT %d' % (self.field, self.table, self.max_size)
+        )
+        for value, rowid in cursor:
+            self.entries[value] = rowid
+        self.loaded = True
+
+    def remember(self, value, rowid):
+        self.entries.pop(value, None)
+        self.entries[value] = rowid
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def lookup(self, value):
+        rowid = self.entries.pop(value, None)
+        if rowid is None:
+            self.misses += 1
+            return None
+        # Reinsert as the most recently used
+        self.entries[value] = rowid
+        self.hits += 1
+        return rowid
+
+    def get(self, conn, value, createnew=True, pending=None):
+        """
+        Returns the rowid of value, inserting it if needed.
+
+        :param conn: database connection of the caller
+        :param value: word or url
+        :param createnew: (default True) -> create new row if not found
+        :param pending: the caller's dict of rows inserted in its open transaction
+        :return: rowid or None if not found and createnew is False
+        """
+        return self.get_many(conn, [value], createnew, pending=pending).get(value)
+
+    def get_many(self, conn, values, createnew=True, chunk_size=500, pending=None):
+        """
+        Resolves many values at once: cached ones from memory, the rest
+        with IN queries, and the new ones with one executemany.
+
+        :param conn: database connection of the caller
+        :param values: iterable of words or urls
+        :param createnew: (default True) -> create rows that are not found
+        :param chunk_size: values per IN (...) query, below SQLite's variable limit
+        :param pending: the caller's dict of rows inserted in its open
+            transaction; new rows go there, and without it they are not
+            remembered at all
+        :return: dict {value: rowid} (without missing values if createnew is False)
+        """
+        if not self.loaded:
+            self.warm_load(conn)
+        result = {}
+        missing = []
+        for value in set(values):
+            rowid = self.lookup(value)
+            if rowid is None and pending:
+                rowid = pending.get(value)
+            if rowid is None:
+                missing.append(value)
+            else:
+                result[value] = rowid
+        if not missing:
+            return result
+
+        found = self.fetch(conn, missing, chunk_size)
+        for value, rowid in found.items():
+            self.remember(value, rowid)
+        result.update(found)
+        new_values = [value for value in missing if value not in found]
+        if new_values and createnew:
+            conn.executemany(
+                'INSERT INTO %s (%s) VALUES (?)' % (self.table, self.field),
+                [(value,) for value in new_values]
+            )
+            inserted = self.fetch(conn, new_values, chunk_size)
+            if pending is not None:
+                pending.update(inserted)
+            result.update(inserted)
+        return result
+
+    def commit(self, pending):
+        """
+        Caches the rows of a committed transaction and empties pending.
+        """
+        for value, rowid in pending.items():
+            self.remember(value, rowid)
+        pending.clear()
+
+    def rollback(self, pending):
+        """
+        Forgets the rows of a rolled back transaction.
+        """
+        pending.clear()
+
+    def fetch(self, conn, values, chunk_size=500):
+        found = {}
+        for start in range(0, len(values), chunk_size):
+            chunk = values[start:start + chunk_size]
+            cursor = conn.execute(
+                'SELECT %s, rowid FROM %s WHERE %s IN (%s)' % (
+                    self.field, self.table, self.field, ','.join('?' * len(chunk))),
+                chunk
+            )
+            found.update(cursor.fetchall())
+        return found
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries),
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+shared = {}
+
+
+def shared_cache(dbname, table, field, max_size=1000000):
+    """
+    Returns the IdCache for one column of a database file, shared by
+    every Crawler and Searcher of this process that opens that file.
+
+    :param dbname: database file name
+    :param table: table name
+    :param field: column name
+    :param max_size: cache size when it is created
+    :return: IdCache
+    """
+    if dbname == ':memory:':
+        # Every connection gets its own in-memory database
+        return IdCache(table, field, max_size)
+    key = (os.path.abspath(dbname), table, field)
+    if key not in shared:
+        shared[key] = IdCache(table, field, max_size)
+    return shared[key]
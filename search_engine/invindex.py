@@ -0,0 +1,526 @@
+import numpy as np
+from pysqlite2 import dbapi2 as sqlite
+
+
+def encode_varints(values):
+    """
+    Encodes non-negative integers as LEB128 varints, 7 bits per byte
+    with the high bit set on every byte but the last of a value.
+
+    :param values: sequence of non-negative integers
+    :return: byte string
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if not len(values):
+        return ''
+    sizes = np.ones(len(values), dtype=np.int64)
+    rest = values >> 7
+    while rest.any():
+        sizes += rest > 0
+        rest >>= 7
+    starts = np.cumsum(sizes) - sizes
+    out = np.zeros(starts[-1] + sizes[-1], dtype=np.uint8)
+    for k in range(sizes.max()):
+        has = sizes > k
+        more = (sizes[has] > k + 1).astype(np.int64) << 7
+        out[starts[has] + k] = ((values[has] >> (7 * k)) & 0x7f) | more
+    return out.tostring()
+
+
+def decode_varints(data):
+    """
+    :param data: byte string (or buffer) from encode_varints
+    :return: int64 array of the values
+    """
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if not len(raw):
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero((raw & 0x80) == 0)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shift = np.arange(len(raw)) - np.repeat(starts, ends - starts + 1)
+    return np.add.reduceat((raw & 0x7f).astype(np.int64) << (7 * shift), starts)
+
+
+class PostingList:
+    """
+    Urls containing one word, in urlid order, with the positions of the
+    word in each of them: the positions of urlids[i] are
+    positions[offsets[i]:offsets[i + 1]], in increasing order.
+    """
+    def __init__(self, urlids, offsets, positions):
+        self.urlids = urlids
+        self.offsets = offsets
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.urlids)
+
+    def locations(self, i):
+        return self.positions[self.offsets[i]:self.offsets[i + 1]]
+
+    def pairs(self):
+        """
+        :return: (urlid, position) arrays, one entry per occurrence
+        """
+        return np.repeat(self.urlids, np.diff(self.offsets)), self.positions
+
+
+def posting_list(urlids, positions):
+    """
+    Builds a PostingList from one (urlid, position) pair per occurrence
+    in any order. Repeated pairs count once.
+
+    :param urlids: urlid array
+    :param positions: position array
+    :return: PostingList
+    """
+    urlids = np.asarray(urlids, dtype=np.int64)
+    positions = np.asarray(positions, dtype=np.int64)
+    order = np.lexsort((positions, urlids))
+    urlids, positions = urlids[order], positions[order]
+    if len(urlids):
+        keep = np.concatenate([[True], (np.diff(urlids) != 0) | (np.diff(positions) != 0)])
+        urlids, positions = urlids[keep], positions[keep]
+    unique, counts = np.unique(urlids, return_counts=True)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return PostingList(unique, offsets, positions)
+
+
+def merge_postings(first, second):
+    """
+    :return: PostingList of the occurrences in either list
+    """
+    if not len(np.intersect1d(first.urlids, second.urlids, assume_unique=True)):
+        # Different urls (like the urls of two crawls): only the blocks
+        # of locations of every url have to be put in urlid order
+        urlids = np.concatenate([first.urlids, second.urlids])
+        order = np.argsort(urlids, kind='mergesort')
+        counts = np.concatenate([np.diff(first.offsets), np.diff(second.offsets)])[order]
+        starts = np.concatenate([first.offsets[:-1], second.offsets[:-1] + len(first.positions)])[order]
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        positions = np.concatenate([first.positions, second.positions])
+        return PostingList(urlids[order], offsets,
+                           positions[np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], counts)])
+    first_urls, first_positions = first.pairs()
+    second_urls, second_positions = second.pairs()
+    return posting_list(np.concatenate([first_urls, second_urls]),
+                        np.concatenate([first_positions, second_positions]))
+
+
+def encode_postings(postings):
+    """
+    Delta-encodes a PostingList: the gaps between urlids, the number of
+    positions per url and the gaps between positions inside each url
+    (the first one from 0), all as varints one after another.
+
+    :return: byte string
+    """
+    counts = np.diff(postings.offsets)
+    gaps = np.diff(postings.positions)
+    if len(gaps):
+        # Positions restart at every url
+        gaps[postings.offsets[1:-1] - 1] = postings.positions[postings.offsets[1:-1]]
+    position_gaps = np.concatenate([postings.positions[0:1], gaps])
+    url_gaps = np.diff(np.concatenate([[0], postings.urlids]))
+    return encode_varints(np.concatenate([url_gaps, counts, position_gaps]))
+
+
+def decode_postings(data, urls):
+    """
+    :param data: byte string from encode_postings
+    :param urls: number of urls in it
+    :return: PostingList
+    """
+    values = decode_varints(data)
+    urlids = np.cumsum(values[0:urls])
+    offsets = np.concatenate([[0], np.cumsum(values[urls:2 * urls])]).astype(np.int64)
+    position_gaps = values[2 * urls:]
+    # Undo the gaps with one cumsum over all urls, then take off what
+    # the urls before each one added
+    positions = np.cumsum(position_gaps)
+    starts = offsets[1:-1]
+    restart = np.zeros(len(positions), dtype=np.int64)
+    restart[starts] = np.diff(np.concatenate([[0], positions[starts - 1]]))
+    positions -= np.cumsum(restart)
+    return PostingList(urlids, offsets, positions)
+
+
+def create_postings_tables(conn):
+    """
+    postings holds the encoded PostingList of every word, postingsstate
+    the last wordlocation rowid merged into it.
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS postings(wordid INTEGER PRIMARY KEY, urls, data)')
+    conn.execute('CREATE TABLE IF NOT EXISTS postingsstate(lastlocation)')
+
+
+def merged_location(conn):
+    """
+    :return: last wordlocation rowid in postings, 0 without postings tables
+    """
+    try:
+        row = conn.execute('SELECT lastlocation FROM postingsstate').fetchone()
+    except sqlite.OperationalError:
+        return 0
+    return row[0] if row is not None else 0
+
+
+def stored_postings(conn, wordid):
+    """
+    :return: PostingList of word in postings, empty if it's not there
+    """
+    try:
+        row = conn.execute('SELECT urls, data FROM postings WHERE wordid = ?', (wordid,)).fetchone()
+    except sqlite.OperationalError:
+        row = None
+    if row is None:
+        return posting_list([], [])
+    return decode_postings(row[1], row[0])
+
+
+def new_postings(conn, last):
+    """
+    Reads the wordlocation rows with rowid above last, grouped by word.
+
+    :param conn: database connection
+    :param last: wordlocation rowid
+    :return: (last rowid read or last, list of (wordid, PostingList) in wordid order)
+    """
+    rows = np.array(conn.execute(
+        'SELECT rowid, wordid, urlid, location FROM wordlocation WHERE rowid > ?', (last,)
+    ).fetchall(), dtype=np.int64).reshape(-1, 4)
+    if not len(rows):
+        return last, []
+    rows = rows[np.argsort(rows[:, 1], kind='mergesort')]
+    wordids, starts = np.unique(rows[:, 1], return_index=True)
+    ends = np.concatenate([starts[1:], [len(rows)]])
+    return int(rows[:, 0].max()), [(wordid, posting_list(rows[start:end, 2], rows[start:end, 3]))
+                                   for wordid, start, end in zip(wordids.tolist(), starts, ends)]
+
+
+def drop_locations(conn, last):
+    """
+    Deletes the wordlocation rows up to last once they are in posting
+    lists, so wordlocation only holds the rows not merged yet. The row
+    last itself stays: SQLite gives a new row the largest rowid plus
+    one, and rowids must keep growing past the ones merged.
+    """
+    conn.execute('DELETE FROM wordlocation WHERE rowid < ?', (last,))
+
+
+def update_postings(conn):
+    """
+    Merges the wordlocation rows added since the last update into the
+    posting lists of their words and deletes them from wordlocation.
+
+    :param conn: database connection
+    :return: number of words updated
+    """
+    create_postings_tables(conn)
+    last, added = new_postings(conn, merged_location(conn))
+    if not added:
+        return 0
+    updates = []
+    for wordid, postings in added:
+        postings = merge_postings(stored_postings(conn, wordid), postings)
+        updates.append((wordid, len(postings), buffer(encode_postings(postings))))
+    conn.executemany('INSERT OR REPLACE INTO postings(wordid, urls, data) VALUES (?, ?, ?)', updates)
+    conn.execute('DELETE FROM postingsstate')
+    conn.execute('INSERT INTO postingsstate VALUES (?)', (last,))
+    drop_locations(conn, last)
+    return len(updates)
+
+
+def read_postings(conn, wordid, last=None, postings=None):
+    """
+    PostingList of a word: the merged one from postings plus the
+    wordlocation rows not merged yet.
+
+    :param conn: database connection
+    :param wordid: word id
+    :param last: merged_location(conn) if already known
+    :param postings: the word's PostingList up to last if it comes from
+        elsewhere than the postings table (see segments.py)
+    :return: PostingList
+    """
+    if last is None:
+        last = merged_location(conn)
+    if postings is None:
+        postings = stored_postings(conn, wordid)
+    tail = np.array(conn.execute(
+        'SELECT urlid, location FROM wordlocation WHERE wordid = ? AND rowid > ?', (wordid, last)
+    ).fetchall(), dtype=np.int64).reshape(-1, 2)
+    if len(tail):
+        postings = merge_postings(postings, posting_list(tail[:, 0], tail[:, 1]))
+    return postings
+
+
+class Matches:
+    """
+    Result of a query: urlids of the matched urls and, per query word,
+    its PostingList and the index of every one of those urls in it, -1
+    for a url without the word (which only OR queries match).
+
+    The locations of a word in the matched urls are only gathered from
+    its posting list when asked for, laid out like a PostingList
+    (locations(w) gives offsets and positions, the locations of
+    urlids[i] being positions[offsets[i]:offsets[i + 1]]). Counts and
+    first locations don't need them.
+    """
+    def __init__(self, urlids, postings, indices):
+        self.urlids = urlids
+        self.postings = postings
+        self.indices = indices
+        # Word -> (offsets, positions), filled by locations
+        self.gathered = {}
+        self.missing = any((i < 0).any() for i in indices)
+
+    def __len__(self):
+        return len(self.urlids)
+
+    def words(self):
+        """
+        :return: number of query words
+        """
+        return len(self.postings)
+
+    def complete(self):
+        """
+        :return: True if every url has every word
+        """
+        return not self.missing
+
+    def counts(self, w):
+        """
+        :return: number of locations of word w in every url
+        """
+        offsets, indices = self.postings[w].offsets, self.indices[w]
+        return np.where(indices >= 0, offsets[indices + 1] - offsets[indices], 0)
+
+    def first_locations(self, w):
+        """
+        :return: first location of word w in every url, -1 where it's missing
+        """
+        postings, indices = self.postings[w], self.indices[w]
+        if not len(postings.positions):
+            return np.zeros(len(indices), dtype=np.int64) - 1
+        return np.where(indices >= 0, postings.positions[np.minimum(
+            postings.offsets[indices], len(postings.positions) - 1)], -1)
+
+    def locations(self, w):
+        """
+        :return: (offsets, positions) of the locations of word w in every url
+        """
+        if w not in self.gathered:
+            self.gathered[w] = gather(self.postings[w], self.indices[w])
+        return self.gathered[w]
+
+    def segments(self, w):
+        """
+        :return: index of the url of every location of word w
+        """
+        return np.repeat(np.arange(len(self.urlids)), self.counts(w))
+
+    def subset(self, selected):
+        """
+        :param selected: sorted indices of urls
+        :return: Matches of just those urls
+        """
+        return Matches(self.urlids[selected], self.postings, [indices[selected] for indices in self.indices])
+
+    def rows(self):
+        """
+        :return: list of tuples [(urlid, locations of word 0, locations of word 1, ...), ...]
+        """
+        columns = [self.urlids.tolist()]
+        for w in range(self.words()):
+            offsets, positions = self.locations(w)
+            columns.append([positions[offsets[i]:offsets[i + 1]].tolist()
+                            for i in range(len(self.urlids))])
+        return zip(*columns)
+
+
+def gather(postings, indices):
+    """
+    :param postings: PostingList
+    :param indices: indices of urls in postings, -1 for none
+    :return: (offsets, positions) of the locations of those urls
+    """
+    starts = postings.offsets[indices]
+    counts = np.where(indices >= 0, postings.offsets[indices + 1] - starts, 0)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    # Index of every wanted location in postings.positions, url after url
+    positions = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], counts)
+    return offsets, postings.positions[positions]
+
+
+def intersect_urls(first, second):
+    """
+    Intersection of two sorted urlid arrays: every urlid of the shorter
+    one is looked up in the longer one by binary search, the vectorized
+    form of galloping, so the time goes with the shorter one.
+    """
+    if len(first) > len(second):
+        first, second = second, first
+    if not len(first):
+        return first
+    found = second[np.minimum(np.searchsorted(second, first), len(second) - 1)] == first
+    return first[found]
+
+
+def union_urls(first, second):
+    """
+    Union of two sorted urlid arrays, merging the urlids of second that
+    aren't in first into it.
+    """
+    if len(first) < len(second):
+        first, second = second, first
+    if not len(second):
+        return first
+    positions = np.searchsorted(first, second)
+    new = first[np.minimum(positions, len(first) - 1)] != second if len(first) else np.ones(len(second), bool)
+    return np.insert(first, positions[new], second[new])
+
+
+def subtract_urls(first, second):
+    """
+    :return: urlids of sorted array first that aren't in sorted array second
+    """
+    if not len(first) or not len(second):
+        return first
+    return first[second[np.minimum(np.searchsorted(second, first), len(second) - 1)] != first]
+
+
+def positional_join(first, second, low, high):
+    """
+    Positional intersection: the urls of both lists in which a location
+    p of first has a location of second between p + low and p + high.
+    A phrase is a chain of these with low = high = the offset of the
+    next word, NEAR/k one with -k and k.
+
+    :param first: PostingList
+    :param second: PostingList
+    :return: PostingList of those urls with just those locations of first
+    """
+    common = intersect_urls(first.urlids, second.urlids)
+    first_offsets, first_positions = gather(first, np.searchsorted(first.urlids, common))
+    second_offsets, second_positions = gather(second, np.searchsorted(second.urlids, common))
+    first_segments = np.repeat(np.arange(len(common)), np.diff(first_offsets))
+    second_segments = np.repeat(np.arange(len(common)), np.diff(second_offsets))
+    # Locations of all urls as one sorted array of keys, shifted so that
+    # p + low and p + high stay in the url's range of keys
+    shift = max(0, -low)
+    span = max([p.max() for p in (first_positions, second_positions) if len(p)] or [0])
+    span += shift + max(high, 0) + 1
+    keys = second_segments * span + second_positions + shift
+    wanted = first_segments * span + first_positions + shift
+    found = np.searchsorted(keys, wanted + high, 'right') > np.searchsorted(keys, wanted + low, 'left')
+    counts = np.bincount(first_segments[found], minlength=len(common))
+    return PostingList(common[counts > 0], np.concatenate([[0], np.cumsum(counts[counts > 0])]).astype(np.int64),
+                       first_positions[found])
+
+
+def match_postings(wordids, read, urls=None):
+    """
+    Looks the words up in the matched urls, by default the urls that
+    contain all of them (conjunctive match by posting list intersection).
+
+    :param wordids: list of word ids
+    :param read: function(wordid) returning the word's PostingList
+    :param urls: sorted urlids matched otherwise, like by a boolean query (see queryparser.py)
+    :return: Matches
+    """
+    if not wordids:
+        return Matches(np.zeros(0, dtype=np.int64), [], [])
+    postings = dict((wordid, read(wordid)) for wordid in set(wordids))
+    if urls is None:
+        # Intersecting from the shortest list keeps the intermediate results small
+        urls = reduce(intersect_urls, [p.urlids for p in sorted(postings.values(), key=len)])
+    indices = []
+    for wordid in wordids:
+        p = postings[wordid]
+        index = np.searchsorted(p.urlids, urls)
+        found = p.urlids[np.minimum(index, len(p) - 1)] == urls if len(p) else np.zeros(len(urls), bool)
+        indices.append(np.where(found, index, -1))
+    return Matches(urls, [postings[wordid] for wordid in wordids], indices)
+
+
+def segment_min(values, segments, width, reverse=False):
+    """
+    Running minimum of values that starts over at every segment, from
+    the front or with reverse from the back. Shifting every segment by
+    width (more than the range of values) below the previous one lets
+    one minimum.accumulate run over all of them.
+    """
+    shift = segments * width
+    if reverse:
+        return np.minimum.accumulate((values + shift)[::-1])[::-1] - shift
+    return np.minimum.accumulate(values - shift) + shift
+
+
+def min_distances(matches):
+    """
+    Smallest sum of |l[w] - l[w - 1]| over all choices of one location
+    l[w] per query word, for every url of matches at once.
+
+    Dynamic programming over the words: the cost of a location of word w
+    is its distance to a location of word w - 1 plus that location's
+    cost, the best one coming from either the closest location before
+    or after it, found with running minima instead of trying every
+    combination. Words a url doesn't have are skipped for it.
+
+    :param matches: Matches
+    :return: int64 array, one distance per url
+    """
+    columns = [matches.locations(w) for w in range(matches.words())]
+    span = max([positions.max() + 1 for (offsets, positions) in columns if len(positions)] or [1])
+    previous = columns[0][1]
+    previous_segments = matches.segments(0)
+    cost = np.zeros(len(previous), dtype=np.int64)
+    for w in range(1, len(columns)):
+        current = columns[w][1]
+        segments = matches.segments(w)
+        # cost is below w * span, so both running minima stay within (w + 2) * span
+        width = (w + 2) * span
+        before = segment_min(cost - previous, previous_segments, width)
+        after = segment_min(cost + previous, previous_segments, width, reverse=True)
+        # Locations of all urls as one sorted array of keys
+        previous_keys = previous_segments * span + previous
+        keys = segments * span + current
+        left = np.searchsorted(previous_keys, keys, 'right') - 1
+        right = np.searchsorted(previous_keys, keys, 'left')
+        best = np.empty(len(current), dtype=np.int64)
+        best.fill(np.iinfo(np.int64).max)
+        has = left >= 0
+        has[has] = previous_segments[left[has]] == segments[has]
+        best[has] = before[left[has]] + current[has]
+        has = right < len(previous)
+        has[has] = previous_segments[right[has]] == segments[has]
+        best[has] = np.minimum(best[has], after[right[has]] - current[has])
+        if matches.complete():
+            previous, previous_segments, cost = current, segments, best
+            continue
+        # Urls without the words before start at word w, urls without
+        # word w keep the locations of the word before
+        started = np.zeros(len(matches), dtype=bool)
+        started[previous_segments] = True
+        best[~started[segments]] = 0
+        present = np.zeros(len(matches), dtype=bool)
+        present[segments] = True
+        kept = ~present[previous_segments]
+        order = np.argsort(np.concatenate([previous_segments[kept] * span + previous[kept], keys]),
+                           kind='mergesort')
+        previous = np.concatenate([previous[kept], current])[order]
+        previous_segments = np.concatenate([previous_segments[kept], segments])[order]
+        cost = np.concatenate([cost[kept], best])[order]
+    if not len(matches):
+        return cost
+    return np.minimum.reduceat(cost, np.searchsorted(previous_segments, np.arange(len(matches))))
+
+
+def least_distance(wordids):
+    """
+    Lower limit of min_distances for a query: 1 for every two
+    consecutive query words that differ, repeated words can share a location.
+    """
+    return sum(1 for (first, second) in zip(wordids, wordids[1:]) if first != second)
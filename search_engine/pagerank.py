@@ -0,0 +1,274 @@
+import time
+
+import numpy as np
+from pysqlite2 import dbapi2 as sqlite
+from scipy.sparse import csr_matrix
+
+# What compute_pagerank does with the rank of pages without links
+DANGLING = (None, 'redistribute')
+
+
+class LinkGraph:
+    """
+    The link table as a sparse matrix.
+
+    urlids holds every urllist rowid in sorted order; node i is urlids[i].
+    matrix[i, j] is 1 / out_degree[j] when page j links to page i, so
+    one mat-vec spreads every page's rank over the pages it links to.
+    Like the book's queries, a parent counts once per page it links to
+    (SELECT DISTINCT fromid), but its out-degree is the number of its
+    link rows (COUNT(*)), repeated links included.
+    
+    :param urlids: sorted array of urlids
+    :param fromids: urlid array of link sources, one entry per distinct link
+    :param toids: urlid array of link targets
+    :param out_degree: number of link rows of every node
+    """
+    def __init__(self, urlids, fromids, toids, out_degree):
+        self.urlids = urlids
+        self.fromids = fromids
+        self.toids = toids
+        count = len(urlids)
+        sources = self.nodes(fromids)
+        targets = self.nodes(toids)
+        self.out_degree = np.asarray(out_degree, dtype=np.float64)
+        weights = 1.0 / self.out_degree[sources]
+        self.matrix = csr_matrix((weights, (targets, sources)), shape=(count, count))
+
+    def __len__(self):
+        return len(self.urlids)
+
+    def nodes(self, urlids):
+        """
+        :return: node indices of urlids (which must all be in the graph)
+        """
+        if len(self.urlids) and self.urlids[-1] - self.urlids[0] + 1 == len(self.urlids):
+            # No rowids missing, as long as no url was deleted
+            return urlids - self.urlids[0]
+        return np.searchsorted(self.urlids, urlids)
+
+
+def link_graph(urlids, fromids, toids):
+    """
+    Builds the LinkGraph of possibly repeated links. Repeated links
+    between two pages are followed once but count in the out-degree;
+    links from a page to itself and links to urls that are not in urlids
+    are ignored.
+
+    :param urlids: sorted array of urlids
+    :param fromids: urlid array of link sources
+    :param toids: urlid array of link targets
+    :return: LinkGraph
+    """
+    known = (fromids != toids) & np.in1d(fromids, urlids) & np.in1d(toids, urlids)
+    out_degree = np.zeros(len(urlids), dtype=np.int64)
+    if len(urlids):
+        out_degree += np.bincount(np.searchsorted(urlids, fromids[known]), minlength=len(urlids))
+    # Deduplicating (from, to) pairs in numpy is much faster than SELECT DISTINCT
+    base = urlids[-1] + 1 if len(urlids) else 1
+    links = np.unique(fromids[known] * base + toids[known])
+    return LinkGraph(urlids, links // base, links % base, out_degree)
+
+
+def read_links(conn):
+    """
+    :return: (fromids, toids) arrays of every link
+    """
+    links = np.array(conn.execute('SELECT fromid, toid FROM link').fetchall(),
+                     dtype=np.int64).reshape(-1, 2)
+    return links[:, 0], links[:, 1]
+
+
+def read_urlids(conn):
+    """
+    :return: sorted array of the urllist rowids
+    """
+    return np.array([row[0] for row in conn.execute('SELECT rowid FROM urllist ORDER BY rowid')],
+                    dtype=np.int64)
+
+
+def load_link_graph(conn):
+    """
+    Reads urllist and link once and builds the LinkGraph.
+
+    :param conn: database connection
+    :return: LinkGraph
+    """
+    fromids, toids = read_links(conn)
+    return link_graph(read_urlids(conn), fromids, toids)
+
+
+def compute_pagerank(graph, damping=0.85, tolerance=1e-6, max_iterations=100, start=None,
+                     dangling=None):
+    """
+    Power iteration of the book's PageRank,
+    pr = (1 - damping) + damping * sum(pr(parent) / links(parent)),
+    until the L1 change of the scores drops below tolerance. It
+    converges to the scores the book's in-place loop approaches; as
+    there, by default the rank of pages without links goes nowhere, so
+    the scores add up to less than the number of pages.
+
+    With dangling='redistribute' a page without links passes its rank
+    to every page evenly, as if it linked to all of them, and the
+    scores keep adding up to the number of pages.
+
+    :param graph: LinkGraph
+    :param damping: probability of following a link
+    :param tolerance: L1 residual at which to stop
+    :param max_iterations: upper limit on iterations
+    :param start: initial scores (default 1.0 for every page)
+    :param dangling: None (the book's) or 'redistribute'
+    :return: (scores, iterations, residual)
+    """
+    if dangling not in DANGLING:
+        raise ValueError('dangling must be one of %r, not %r' % (DANGLING, dangling))
+    count = len(graph)
+    if start is None:
+        scores = np.ones(count)
+    else:
+        scores = np.array(start, dtype=np.float64)
+    sinks = np.flatnonzero(graph.out_degree == 0)
+    residual = 0.0
+    iterations = 0
+    while iterations < max_iterations and count:
+        new_scores = graph.matrix.dot(scores)
+        if dangling == 'redistribute':
+            new_scores += scores[sinks].sum() / count
+        new_scores = (1 - damping) + damping * new_scores
+        residual = np.abs(new_scores - scores).sum()
+        scores = new_scores
+        iterations += 1
+        if residual < tolerance:
+            break
+    return scores, iterations, residual
+
+
+def write_pagerank(conn, urlids, scores):
+    """
+    Replaces the pagerank table with new scores in one executemany.
+
+    :param conn: database connection
+    :param urlids: urlid of every score
+    :param scores: PageRank scores
+    """
+    conn.execute('DROP TABLE IF EXISTS pagerank')
+    conn.execute('CREATE TABLE pagerank(urlid PRIMARY KEY, score)')
+    conn.executemany(
+        'INSERT INTO pagerank(urlid, score) VALUES (?, ?)',
+        zip(urlids.tolist(), scores.tolist())
+    )
+
+
+def read_pagerank(conn, graph):
+    """
+    :return: stored score of every node of graph, 1.0 for urls without one
+    """
+    scores = np.ones(len(graph))
+    rows = np.array(conn.execute('SELECT urlid, score FROM pagerank').fetchall(),
+                    dtype=np.float64).reshape(-1, 2)
+    urlids = rows[:, 0].astype(np.int64)
+    known = np.in1d(urlids, graph.urlids)
+    scores[graph.nodes(urlids[known])] = rows[known, 1]
+    return scores
+
+
+def create_state_tables(conn):
+    """
+    State of skip_unchanged, all of it O(1) or O(changes):
+    pagerankstate has the last link and urllist rowids the last run saw,
+    so rows added after it are found by rowid, and its dangling mode,
+    and pagerankchanges gets
+    the link rows deleted or changed and the urls deleted since then,
+    from triggers, as rowids don't show those.
+    """
+    if len(conn.execute('PRAGMA table_info(pagerankstate)').fetchall()) not in (0, 3):
+        # The table of before the dangling mode was saved, or of when
+        # the whole graph was saved in it as BLOBs
+        conn.execute('DROP TABLE pagerankstate')
+    conn.execute('CREATE TABLE IF NOT EXISTS pagerankstate(lastlink, lasturl, dangling)')
+    conn.execute('CREATE TABLE IF NOT EXISTS pagerankchanges(links, urlid)')
+    conn.execute('CREATE TRIGGER IF NOT EXISTS pagerank_link_delete AFTER DELETE ON link '
+                 'BEGIN INSERT INTO pagerankchanges VALUES (1, NULL); END')
+    conn.execute('CREATE TRIGGER IF NOT EXISTS pagerank_link_update AFTER UPDATE ON link '
+                 'BEGIN INSERT INTO pagerankchanges VALUES (1, NULL); END')
+    conn.execute('CREATE TRIGGER IF NOT EXISTS pagerank_url_delete AFTER DELETE ON urllist '
+                 'BEGIN INSERT INTO pagerankchanges VALUES (0, old.rowid); END')
+
+
+def read_state(conn, dangling=None):
+    """
+    :return: (lastlink, lasturl, links changed, urlids deleted) since
+             the last run, or a string saying why there is nothing to
+             start from
+    """
+    triggers = conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'pagerank_%'"
+    ).fetchone()[0]
+    try:
+        row = conn.execute('SELECT lastlink, lasturl, dangling FROM pagerankstate').fetchone()
+        changes = conn.execute('SELECT links, urlid FROM pagerankchanges').fetchall()
+    except sqlite.OperationalError:
+        # Database from before the saved state or the dangling mode,
+        # or from when it kept the graph as BLOBs
+        return 'no saved state'
+    if row is None:
+        return 'no saved state'
+    if row[2] != dangling:
+        return 'dangling mode changed from %r' % row[2]
+    if triggers < 3:
+        # Dropping link or urllist drops their triggers too
+        return 'link or urllist was recreated'
+    return row[0], row[1], sum(links for links, urlid in changes), \
+        [urlid for links, urlid in changes if urlid is not None]
+
+
+def write_state(conn, lastlink, lasturl, dangling=None):
+    """
+    Saves the rowids the run saw and forgets the changes it covered.
+    """
+    create_state_tables(conn)
+    conn.execute('DELETE FROM pagerankstate')
+    conn.execute('INSERT INTO pagerankstate VALUES (?, ?, ?)', (lastlink, lasturl, dangling))
+    conn.execute('DELETE FROM pagerankchanges')
+
+
+def calculate_pagerank(conn, damping=0.85, tolerance=1e-6, max_iterations=100,
+                       skip_unchanged=False, dangling=None):
+    """
+    Loads the link graph, iterates to convergence and writes the scores back.
+
+    With skip_unchanged the run is skipped when no link or url was
+    added, changed or deleted since the last one. Otherwise the whole
+    graph is iterated and every score written again, starting from the
+    stored scores, which saves iterations but nothing else: one changed
+    link moves the scores of nearly every page reachable from it (more
+    than 90% of them on a 300k link crawl), so there is no smaller set
+    of pages to propagate the change over. Without a usable previous
+    run, or if it used another dangling mode (see compute_pagerank), it
+    starts from 1.0 and says why in the reason.
+
+    :return: dict with mode, reason, iterations, residual, urls, links and seconds
+    """
+    start = time.time()
+    lastlink = conn.execute('SELECT MAX(rowid) FROM link').fetchone()[0] or 0
+    lasturl = conn.execute('SELECT MAX(rowid) FROM urllist').fetchone()[0] or 0
+    state = read_state(conn, dangling) if skip_unchanged else None
+    # The rowids can only go back if the tables were recreated
+    if isinstance(state, tuple) and (state[0] > lastlink or state[1] > lasturl):
+        state = 'link or urllist was recreated'
+
+    if state == (lastlink, lasturl, 0, []):
+        return {'mode': 'unchanged', 'reason': None, 'iterations': 0, 'residual': 0.0,
+                'urls': 0, 'links': 0, 'seconds': time.time() - start}
+
+    graph = load_link_graph(conn)
+    if isinstance(state, tuple):
+        mode, reason, stored = 'warm', None, read_pagerank(conn, graph)
+    else:
+        mode, reason, stored = 'full', state, None
+    scores, iterations, residual = compute_pagerank(graph, damping, tolerance, max_iterations,
+                                                    start=stored, dangling=dangling)
+    write_pagerank(conn, graph.urlids, scores)
+    write_state(conn, lastlink, lasturl, dangling)
+    return {'mode': mode, 'reason': reason, 'iterations': iterations, 'residual': residual,
+            'urls': len(graph), 'links': graph.matrix.nnz, 'seconds': time.time() - start}
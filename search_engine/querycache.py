@@ -0,0 +1,116 @@
+import sys
+from collections import OrderedDict
+
+import numpy as np
+from pysqlite2 import dbapi2 as sqlite
+
+
+def create_generation_table(conn):
+    """
+    indexgeneration holds one counter that every change of the index
+    increases (see Crawler.dbcommit).
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS indexgeneration(generation)')
+    if conn.execute('SELECT COUNT(*) FROM indexgeneration').fetchone()[0] == 0:
+        conn.execute('INSERT INTO indexgeneration VALUES (0)')
+
+
+def bump_generation(conn):
+    conn.execute('UPDATE indexgeneration SET generation = generation + 1')
+
+
+def index_generation(conn):
+    """
+    :return: current index generation, None for a database without the counter
+    """
+    try:
+        row = conn.execute('SELECT generation FROM indexgeneration').fetchone()
+    except sqlite.OperationalError:
+        return None
+    return row[0] if row is not None else None
+
+
+def size_of(value):
+    """
+    Rough number of bytes a cached value holds: the buffers of numpy
+    arrays and the shallow size of everything else, recursing into
+    tuples, lists and objects.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(size_of(v) for v in value)
+    if hasattr(value, '__dict__'):
+        return sys.getsizeof(value) + sum(size_of(v) for v in value.__dict__.values())
+    return sys.getsizeof(value)
+
+
+class QueryCache:
+    """
+    LRU cache of query results and posting lists for one Searcher.
+
+    Every entry is stamped with the index generation it was computed at
+    and only served while the generation is still the same, so nothing
+    the crawler or calculate_pagerank changed since is ever returned.
+    Keys are (kind, ...) tuples; hits and misses are counted per kind.
+    At most max_entries entries and max_bytes bytes (estimated with
+    size_of) are kept.
+    """
+    def __init__(self, max_entries=1000, max_bytes=64 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = {}
+        self.misses = {}
+        self.evictions = 0
+
+    def get(self, key, generation):
+        """
+        :return: cached value of key at this generation or None
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[0] == generation and generation is not None:
+            # Reinsert as the most recently used
+            self.entries[key] = entry
+            self.hits[key[0]] = self.hits.get(key[0], 0) + 1
+            return entry[1]
+        if entry is not None:
+            self.bytes -= entry[2]
+        self.misses[key[0]] = self.misses.get(key[0], 0) + 1
+        return None
+
+    def put(self, key, generation, value):
+        """
+        Stores value, unless the database has no generation counter.
+
+        :return: value
+        """
+        if generation is None:
+            return value
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+        size = size_of(value)
+        self.entries[key] = (generation, value, size)
+        self.bytes += size
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            evicted = self.entries.popitem(last=False)[1]
+            self.bytes -= evicted[2]
+            self.evictions += 1
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        """
+        :return: dict with entries, bytes, evictions and hits, misses and hit_rate per kind
+        """
+        result = {'entries': len(self.entries), 'bytes': self.bytes, 'evictions': self.evictions}
+        for kind in set(self.hits) | set(self.misses):
+            hits, misses = self.hits.get(kind, 0), self.misses.get(kind, 0)
+            result[kind] = {'hits': hits, 'misses': misses,
+                            'hit_rate': float(hits) / (hits + misses) if hits + misses else 0.0}
+        return result
@@ -0,0 +1,305 @@
+import re
+
+import numpy as np
+
+from invindex import intersect_urls, positional_join, subtract_urls, union_urls
+
+# A quoted phrase, a NEAR/k operator, a parenthesis or a word
+TOKENS = re.compile(r'"([^"]*)"|NEAR/(\d+)|([()])|([^\s()"]+)')
+OPERATORS = set(['AND', 'OR', 'NOT'])
+
+NOTHING = np.zeros(0, dtype=np.int64)
+
+
+class Word:
+    """
+    A query word.
+    """
+    def __init__(self, word):
+        self.word = word
+
+    def words(self):
+        return [self.word]
+
+    def span(self):
+        """
+        :return: number of places a match extends past its location
+        """
+        return 0
+
+    def postings(self, read):
+        """
+        :param read: function(word) returning the PostingList of a word, None if it isn't indexed
+        :return: PostingList of the urls that match, with the locations where they do
+        """
+        return read(self.word)
+
+    def urls(self, read):
+        """
+        :param read: function(word) returning the PostingList of a word, None if it isn't indexed
+        :return: sorted urlids that match, None for a word that isn't indexed,
+            which is left out of the query
+        """
+        postings = read(self.word)
+        return postings.urlids if postings is not None else None
+
+
+class Phrase:
+    """
+    Words that have to follow each other, offsets[i] being the place of
+    phrase[i] in it. Left out words (like ignored ones) keep
+    their place, the way the crawler keeps counting locations over them.
+    """
+    def __init__(self, phrase, offsets):
+        self.phrase = phrase
+        self.offsets = offsets
+
+    def words(self):
+        return list(self.phrase)
+
+    def span(self):
+        return self.offsets[-1] - self.offsets[0]
+
+    def postings(self, read):
+        """
+        :return: PostingList of the urls with the phrase, located at its first word
+        """
+        result = read(self.phrase[0])
+        for word, offset in zip(self.phrase[1:], self.offsets[1:]):
+            postings = read(word)
+            if result is None or postings is None:
+                return None
+            result = positional_join(result, postings, offset - self.offsets[0], offset - self.offsets[0])
+        return result
+
+    def urls(self, read):
+        """
+        :return: sorted urlids that match, none if a word isn't indexed
+        """
+        postings = self.postings(read)
+        return postings.urlids if postings is not None else NOTHING
+
+
+class Near:
+    """
+    Two parts of the query at most distance words apart, in either order.
+    A phrase counts from whichever of its ends is nearer to the other
+    part: the distance is the gap between the two spans of words, 0 if
+    they overlap. A Near used as a part again counts as its left part.
+    """
+    def __init__(self, left, right, distance):
+        self.left = left
+        self.right = right
+        self.distance = distance
+
+    def words(self):
+        return self.left.words() + self.right.words()
+
+    def span(self):
+        return self.left.span()
+
+    def postings(self, read):
+        """
+        :return: PostingList of the urls where they are close enough, located at the left part
+        """
+        left, right = self.left.postings(read), self.right.postings(read)
+        if left is None or right is None:
+            return None
+        # The right part may start up to distance after the end of the
+        # left one, or end up to distance before its start
+        return positional_join(left, right, -self.distance - self.right.span(),
+                               self.distance + self.left.span())
+
+    def urls(self, read):
+        postings = self.postings(read)
+        return postings.urlids if postings is not None else NOTHING
+
+
+class Not:
+    """
+    A part of the query the urls must not match. It only narrows down
+    the other parts of an And, on its own or in an Or it matches nothing.
+    """
+    def __init__(self, part):
+        self.part = part
+
+    def words(self):
+        # The words of excluded parts don't go to the scorers
+        return []
+
+    def urls(self, read):
+        return NOTHING
+
+
+class And:
+    """
+    Parts of the query that all have to match.
+    """
+    def __init__(self, parts):
+        self.parts = parts
+
+    def words(self):
+        return [word for part in self.parts for word in part.words()]
+
+    def urls(self, read):
+        """
+        Intersects the urls of the parts, shortest first, then takes out
+        the urls of the Not parts.
+
+        :return: sorted urlids, None if no part has an indexed word
+        """
+        matched = [urls for urls in (part.urls(read) for part in self.parts if not isinstance(part, Not))
+                   if urls is not None]
+        excluded = [urls for urls in (part.part.urls(read) for part in self.parts if isinstance(part, Not))
+                    if urls is not None]
+        if not matched:
+            return None if not excluded else NOTHING
+        result = reduce(intersect_urls, sorted(matched, key=len))
+        for urls in excluded:
+            result = subtract_urls(result, urls)
+        return result
+
+
+class Or:
+    """
+    Parts of the query of which at least one has to match.
+    """
+    def __init__(self, parts):
+        self.parts = parts
+
+    def words(self):
+        return [word for part in self.parts for word in part.words()]
+
+    def urls(self, read):
+        """
+        Merges the urls of the parts, smallest first.
+
+        :return: sorted urlids, None if no part has an indexed word
+        """
+        matched = [urls for urls in (part.urls(read) for part in self.parts) if urls is not None]
+        if not matched:
+            return None
+        return reduce(union_urls, sorted(matched, key=len))
+
+
+class QueryParser:
+    """
+    Recursive descent parser of the query language:
+
+        query  = or
+        or     = and ('OR' and)*
+        and    = unary (['AND'] unary)*
+        unary  = 'NOT' unary | near
+        near   = term ('NEAR/k' term)*
+        term   = '(' or ')' | '"phrase"' | word
+
+    Words next to each other have to match all, as before there were
+    operators. Operators are upper case, so 'or' is still a word. It
+    never fails: a missing ')' is taken to be at the end, a stray one
+    and operators without operands are left out, and NEAR between a
+    group and something else is an AND.
+    """
+    def __init__(self, query, ignore=()):
+        self.tokens = TOKENS.findall(query)
+        self.position = 0
+        self.ignore = ignore
+
+    def peek(self):
+        """
+        :return: next token as (phrase, distance, parenthesis, word), None at the end
+        """
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def is_operator(self, name):
+        token = self.peek()
+        return token is not None and token[3] == name
+
+    def parse(self):
+        """
+        :return: And, Or, Not, Near, Phrase or Word, None for a query without words
+        """
+        parts = [self.parse_or()]
+        while self.peek() is not None:
+            # A stray ')'
+            self.position += 1
+            parts.append(self.parse_or())
+        return self.join(And, parts)
+
+    def join(self, kind, parts):
+        parts = [part for part in parts if part is not None]
+        if len(parts) <= 1:
+            return parts[0] if parts else None
+        return kind(parts)
+
+    def parse_or(self):
+        parts = [self.parse_and()]
+        while self.is_operator('OR'):
+            self.position += 1
+            parts.append(self.parse_and())
+        return self.join(Or, parts)
+
+    def parse_and(self):
+        parts = []
+        while self.peek() is not None and self.peek()[2] != ')' and not self.is_operator('OR'):
+            if self.is_operator('AND'):
+                self.position += 1
+                continue
+            parts.append(self.parse_unary())
+        return self.join(And, parts)
+
+    def parse_unary(self):
+        if self.is_operator('NOT'):
+            self.position += 1
+            part = self.parse_unary()
+            return Not(part) if part is not None else None
+        return self.parse_near()
+
+    def parse_near(self):
+        left = self.parse_term()
+        while self.peek() is not None and self.peek()[1]:
+            distance = int(self.peek()[1])
+            self.position += 1
+            right = self.parse_term()
+            if left is None or right is None:
+                left = left or right
+            elif all(isinstance(part, (Word, Phrase, Near)) for part in (left, right)):
+                left = Near(left, right, distance)
+            else:
+                left = And([left, right])
+        return left
+
+    def parse_term(self):
+        token = self.peek()
+        if token is None or token[2] == ')' or token[1] or token[3] in OPERATORS:
+            return None
+        self.position += 1
+        phrase, distance, parenthesis, word = token
+        if parenthesis == '(':
+            part = self.parse_or()
+            if self.peek() is not None:
+                # The ')'
+                self.position += 1
+            return part
+        if word:
+            return Word(word) if word not in self.ignore else None
+        words = phrase.split()
+        kept = [i for i, w in enumerate(words) if w not in self.ignore]
+        if not kept:
+            return None
+        if len(kept) == 1:
+            return Word(words[kept[0]])
+        return Phrase([words[i] for i in kept], kept)
+
+
+def parse_query(query, ignore=()):
+    """
+    Parses a query of words, "quoted phrases", NEAR/k between two of
+    them and AND, OR, NOT and parentheses, e.g.
+    '("serbian war" NEAR/5 criminal OR tribunal) NOT film'.
+
+    :param query: query string
+    :param ignore: words that are never indexed; they are left out of
+        the query, in phrases they keep their place
+    :return: And, Or, Not, Near, Phrase or Word, None for a query without words
+    """
+    return QueryParser(query, ignore).parse()
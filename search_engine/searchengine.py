@@ -1,25 +1,75 @@
 import re
+import threading
+import time
 import urllib2
 from pysqlite2 import dbapi2 as sqlite
+from multiprocessing.pool import ThreadPool
 from urlparse import urljoin
 import nn
+import features
+from fetcher import FetchPool
+from idcache import shared_cache
+import invindex
+import pagerank
+import queryparser
+import segments
+from querycache import QueryCache, create_generation_table, bump_generation, index_generation
+from topk import top_k_indices
 
 import bs4 as bs
+import numpy as np
 
 ignorewords = set(['the', 'of', 'to', 'and', 'a', 'in', 'is', 'it'])
-mynet = nn.SearchNet(nn.db)
+mynet = nn.SearchNet('nn.db')
 
 
 class Crawler:
     # Initialize the crawler with the name of database
     def __init__(self, dbname):
+        self.dbname = dbname
         self.conn = sqlite.connect(dbname)
+        # Title words of the indexed pages, databases from before it don't have it
+        self.conn.execute('CREATE TABLE IF NOT EXISTS titlewords(urlid, wordid)')
+        # Number of indexed words of every indexed page. wordlocation only
+        # keeps the rows not in the posting lists yet (see update_postings),
+        # so a database from before it gets it filled from wordlocation.
+        tables = set(name for (name,) in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        if 'pagelength' not in tables:
+            self.conn.execute('CREATE TABLE pagelength(urlid INTEGER PRIMARY KEY, length)')
+            if 'wordlocation' in tables:
+                self.conn.execute('INSERT INTO pagelength SELECT urlid, COUNT(*) FROM wordlocation GROUP BY urlid')
+        # Counter dbcommit increases, Searcher caches results per value of it
+        create_generation_table(self.conn)
+        # Version of the static features the database was committed with
+        features.create_features_table(self.conn)
+        self.conn.commit()
+        # Id caches shared with every Searcher of this database
+        self.caches = {
+            ('wordlist', 'word'): shared_cache(dbname, 'wordlist', 'word'),
+            ('urllist', 'url'): shared_cache(dbname, 'urllist', 'url'),
+        }
+        # Rows this crawler inserted since its last commit, they only go
+        # into the shared caches once they are committed
+        self.pending = dict((key, {}) for key in self.caches)
+        # urlids known to be in pagelength
+        self.indexed = set()
 
     def __del__(self):
         self.conn.close()
 
     def dbcommit(self):
+        # Every commit makes cached search results stale
+        bump_generation(self.conn)
         self.conn.commit()
+        for key, cache in self.caches.items():
+            cache.commit(self.pending[key])
+
+    def dbrollback(self):
+        # The rowids of rolled back rows will be given out again
+        self.conn.rollback()
+        for key, cache in self.caches.items():
+            cache.rollback(self.pending[key])
+        self.indexed.clear()
 
     def get_entry_id(self, table, field, value, createnew=True):
         """
@@ -32,6 +82,9 @@ class Crawler:
         :param createnew: (default True) -> create new row if not found
         :return: found row in database or newly created
         """
+        if (table, field) in self.caches:
+            return self.caches[(table, field)].get(self.conn, value, createnew,
+                                                   pending=self.pending[(table, field)])
         cursor = self.conn.execute(
             "SELECT rowid FROM %s WHERE %s = '%s'" % (table, field, value)
         )
@@ -63,16 +116,23 @@ class Crawler:
         # Get URL id
         urlid = self.get_entry_id('urllist', 'url', url)
 
-        # Link each word to this url
-        # todo make it more efficient
-        for i in range(len(words)):
-            word = words[i]
-            if word in ignorewords:
-                continue
-            wordid = self.get_entry_id('wordlist', 'word', word)
-            self.conn.execute(
-                'INSERT INTO wordlocation(urlid, wordid, location) VALUES (%d, %d, %d)' % (urlid, wordid, i)
-            )
+        # Words of the title, for the static features
+        title = set()
+        if soup.title is not None:
+            title = set(self.separate_words(self.get_text(soup.title))) - ignorewords
+
+        # Link each word to this url, all locations in one executemany.
+        # Nothing is committed here, so the page goes in as one transaction.
+        wordids = self.caches[('wordlist', 'word')].get_many(self.conn, (set(words) | title) - ignorewords,
+                                                             pending=self.pending[('wordlist', 'word')])
+        locations = [(urlid, wordids[word], i) for i, word in enumerate(words) if word not in ignorewords]
+        self.conn.executemany('INSERT INTO wordlocation(urlid, wordid, location) VALUES (?, ?, ?)', locations)
+        self.conn.execute('INSERT INTO pagelength(urlid, length) VALUES (?, ?)', (urlid, len(locations)))
+        self.conn.executemany(
+            'INSERT INTO titlewords(urlid, wordid) VALUES (?, ?)',
+            [(urlid, wordids[word]) for word in title]
+        )
+        self.indexed.add(urlid)
 
     def get_text(self, soup):
         """
@@ -109,15 +169,16 @@ class Crawler:
         :param url: url name
         :return: Boolean
         """
-        u = self.conn.execute(
-            "SELECT rowid FROM urllist WHERE url = '%s'" % url
-        ).fetchone()
-        if u is not None:
+        urlid = self.get_entry_id('urllist', 'url', url, createnew=False)
+        if urlid is not None:
+            if urlid in self.indexed:
+                return True
             # Check if it has actually been crawled
             v = self.conn.execute(
-                'SELECT * FROM wordlocation WHERE urlid = %d' % u[0]
+                'SELECT * FROM pagelength WHERE urlid = %d' % urlid
             ).fetchone()
             if v is not None:
+                self.indexed.add(urlid)
                 return True
         return False
 
@@ -150,39 +211,116 @@ class Crawler:
                 "INSERT INTO linkwords(linkid, wordid) VALUES (%d, %d)" % (linkid, wordid)
             )
 
-    def crawl(self, pages, depth=2):
+    def crawl(self, pages, depth=2, workers=0, per_host=2, delay=0.0):
         """
         Starting with a list of pages do a breadth
         first search to the given depth, indexing pages as we go
         
         :param pages: list of pages to start crawling from
         :param depth: maximum depth for crawling pages
-        """
+        :param workers: (default 0) -> number of fetch threads, 0 fetches serially
+        :param per_host: concurrent requests per host when workers > 0
+        :param delay: seconds between requests to the same host when workers > 0
+        """
+        if workers > 0:
+            return self.crawl_concurrent(pages, depth, workers, per_host, delay)
+        # Every page is fetched once per crawl
+        seen = set()
         for i in range(depth):
             new_pages = set()
             for page in pages:
+                if page in seen:
+                    continue
+                seen.add(page)
                 try:
                     c = urllib2.urlopen(page)
                 except:
                     print 'Can\'t open %s' % page
                     continue
-                soup = bs.BeautifulSoup(c.read(), 'html.parser')
-                self.add_to_index(page, soup)
-
-                links = soup('a')
-                for link in links:
-                    if 'href' in dict(link.attrs):
-                        url = urljoin(page, link['href'])
-                        if url.find("'") != -1:
-                            # example: javascript:printOrder('http://www.serbianrailways.com/active/.../print.html')
-                            continue
-                        url = url.split('#')[0]  # remove location portion
-                        if url[0:4] == 'http' and not self.is_indexed(url):
-                            new_pages.add(url)
-                        link_text = self.get_text(link)
-                        self.add_link_ref(page, url, link_text)
+                new_pages.update(self.index_page(page, c.read()))
                 self.dbcommit()
             pages = new_pages
+        self.update_postings()
+        self.build_features()
+
+    def crawl_concurrent(self, pages, depth=2, workers=8, per_host=2, delay=0.0):
+        """
+        Same breadth first crawl as crawl() with the network I/O in a
+        pool of fetch threads.
+        
+        Fetch threads only download pages; parsing, indexing and commits
+        stay in this thread, which owns the database connection. A level
+        is fetched concurrently, but the next one only starts when it is
+        done, so every page gets the same depth, and the same pages and
+        links are stored, as in the serial crawl.
+        
+        :param pages: list of pages to start crawling from
+        :param depth: maximum depth for crawling pages
+        :param workers: number of fetch threads
+        :param per_host: maximum concurrent requests to one host
+        :param delay: minimum seconds between requests to one host
+        """
+        pool = FetchPool(workers, per_host, delay)
+        seen = set()
+        try:
+            for i in range(depth):
+                pending = 0
+                for page in pages:
+                    if page not in seen:
+                        seen.add(page)
+                        pool.submit(page, i)
+                        pending += 1
+                new_pages = set()
+                while pending > 0:
+                    page, level, html = pool.results.get()
+                    pending -= 1
+                    if html is None:
+                        print 'Can\'t open %s' % page
+                        continue
+                    new_pages.update(self.index_page(page, html))
+                    self.dbcommit()
+                pages = new_pages
+        finally:
+            pool.close()
+        self.update_postings()
+        self.build_features()
+
+    def index_page(self, page, html):
+        """
+        Indexes a downloaded page and stores its links.
+        
+        :param page: page url
+        :param html: page source
+        :return: set of linked urls that are not indexed yet
+        """
+        try:
+            return self.store_page(page, html)
+        except:
+            # Nothing of a page that failed halfway gets committed
+            self.dbrollback()
+            raise
+
+    def store_page(self, page, html):
+        new_pages = set()
+        soup = bs.BeautifulSoup(html, 'html.parser')
+        # The links of a page are stored when it gets indexed, a page
+        # indexed before (by an earlier crawl) is only followed
+        store_links = not self.is_indexed(page)
+        self.add_to_index(page, soup)
+
+        links = soup('a')
+        for link in links:
+            if 'href' in dict(link.attrs):
+                url = urljoin(page, link['href'])
+                if url.find("'") != -1:
+                    # example: javascript:printOrder('http://www.serbianrailways.com/active/.../print.html')
+                    continue
+                url = url.split('#')[0]  # remove location portion
+                if url[0:4] == 'http' and not self.is_indexed(url):
+                    new_pages.add(url)
+                if store_links:
+                    self.add_link_ref(page, url, self.get_text(link))
+        return new_pages
 
     def create_index_tables(self):
         """
@@ -198,137 +336,414 @@ class Crawler:
         self.conn.execute('CREATE INDEX wordurlidx ON wordlocation(wordid)')
         self.conn.execute('CREATE INDEX urltoidx ON link(toid)')
         self.conn.execute('CREATE INDEX urlfromidx ON link(fromid)')
+        self.conn.execute('CREATE INDEX linkwordidx ON linkwords(wordid)')
+        invindex.create_postings_tables(self.conn)
+        # Segments of a database that had these tables before
+        segments.clear_segments(segments.segments_path(self.dbname))
         self.dbcommit()
 
-    def calculate_pagerank(self, iterations=20):
+    def update_postings(self):
+        """
+        Moves the words indexed since the last call from wordlocation to
+        a new segment of posting lists next to the database, merging
+        segments as they pile up (see segments.py). An in-memory database
+        keeps them in its postings table instead (see invindex.py).
+        Searcher also reads the words that are in neither yet, so this
+        only keeps them from piling up.
+        
+        :return: number of words updated
+        """
+        path = segments.segments_path(self.dbname)
+        if path is None:
+            words = invindex.update_postings(self.conn)
+            self.dbcommit()
+        else:
+            words, merges, removed = segments.update_segments(self.conn, path)
+            self.dbcommit()
+            segments.remove_segments(path, removed)
+        return words
+
+    def calculate_pagerank(self, iterations=100, tolerance=1e-6, skip_unchanged=False, dangling=None):
         """
         Creates pagerank table in database and calculates 
         PageRank scores for all indexed urls.
         
-        :param iterations: Number of iterations for calculating precise PR score
+        The link table is read once into a sparse matrix (see pagerank.py)
+        and iterated until the scores stop changing. The static features
+        are built again afterwards.
+        
+        :param iterations: Maximum number of iterations
+        :param tolerance: Total change of scores at which iterating stops
+        :param skip_unchanged: (default False) -> skip the run if the links didn't
+            change, else start iterating from the stored scores
+        :param dangling: (default None) -> the book's PageRank, where pages without
+            links pass their rank to nobody; 'redistribute' spreads it over every page
+        :return: dict with mode, reason, iterations, residual, urls, links and seconds
+        """
+        stats = pagerank.calculate_pagerank(self.conn, tolerance=tolerance, max_iterations=iterations,
+                                            skip_unchanged=skip_unchanged, dangling=dangling)
+        if stats['mode'] == 'unchanged':
+            # Only the state tables may be new, results and features stay valid
+            self.conn.commit()
+            print 'PageRank: no link or url changed since the last run'
+            return stats
+        self.dbcommit()
+        if stats['reason'] is not None:
+            print 'PageRank: full run, %s' % stats['reason']
+        print 'PageRank (%(mode)s): %(iterations)d iterations, residual %(residual)g, ' \
+              '%(urls)d urls, %(links)d links, %(seconds).2fs' % stats
+        self.build_features()
+        return stats
+
+    def build_features(self):
+        """
+        Saves the query independent features of every url (inbound links,
+        PageRank, length, title words) as arrays next to the database,
+        for Searcher to memory-map (see features.py), and commits. They
+        are used until the next commit, crawl() builds them again at its end.
+        
+        :return: features.Features or None for an in-memory database
         """
-        # Clear out current PageRank tables
-        self.conn.execute('DROP TABLE IF EXISTS pagerank')
-        self.conn.execute('CREATE TABLE pagerank(urlid PRIMARY KEY, score)')
-
-        # Init every url with a PageRank of 1
-        self.conn.execute('INSERT INTO pagerank SELECT rowid, 1.0 FROM urllist')
+        path = features.features_path(self.dbname)
+        if path is None:
+            return None
+        built = features.build_features(self.conn, path)
         self.dbcommit()
-
-        for i in range(iterations):
-            print 'PageRank Iteration: %d' % i
-            url_list = self.conn.execute('SELECT rowid FROM urllist')  # query urlid from urllist
-            for (urlid,) in url_list:
-                pr = 0.15
-
-                # Loop through al the parent pages that link to this one
-                parent_list = self.conn.execute(
-                    'SELECT DISTINCT fromid FROM link WHERE toid=%d' % urlid
-                )
-                for (parent_id,) in parent_list:
-                    # Get the PageRank of the parent
-                    cursor = self.conn.execute(
-                        'SELECT score FROM pagerank WHERE urlid=%d' % parent_id
-                    )
-                    parent_pagerank = cursor.fetchone()[0]
-
-                    # Get the total number of links to other pages from the parent page
-                    temp = self.conn.execute(
-                        'SELECT COUNT(*) FROM link WHERE fromid=%d' % parent_id
-                    )
-                    parent_link_count = temp.fetchone()[0]
-                    pr += 0.85 * (parent_pagerank / parent_link_count)
-                self.conn.execute(
-                    'UPDATE pagerank SET score=%f WHERE urlid=%d' % (pr, urlid)
-                )
-            self.dbcommit()
+        features.remove_old_versions(path, built.version)
+        return built
 
 
 class Searcher:
-    def __init__(self, dbname):
+    # Weight of every metric in get_scored_list, 0 leaves one out
+    weights = [
+        (1.0, 'frequency'),
+        (1.0, 'location'),
+        (1.0, 'distance'),
+        (0.5, 'inbound_link'),
+        (1.0, 'pagerank'),
+        (1.0, 'link_text'),
+        (0.0, 'title'),
+    ]
+
+    # Metrics query leaves out until a url can still make the top 10 with
+    # them (see get_top_k), the others are computed for every match
+    bounded_metrics = set(['distance'])
+
+    # Metrics that stay in the calling thread with scorer_threads: nn_score
+    # goes through the module's mynet, whose connection belongs to the
+    # thread that made it
+    same_thread_metrics = set(['nn'])
+
+    def __init__(self, dbname, cache_entries=1000, cache_bytes=64 << 20, scorer_threads=0):
+        """
+        :param dbname: database file name
+        :param cache_entries: (default 1000) -> size of the LRU cache of query
+            results and posting lists, 0 turns it off
+        :param cache_bytes: (default 64MB) -> memory limit of that cache
+        :param scorer_threads: (default 0) -> number of threads running the
+            scorers concurrently, each with its own connection; 0, or an
+            in-memory database that other connections can't see, runs
+            them one after another
+        """
+        self.dbname = dbname
         self.conn = sqlite.connect(dbname)
+        self.words = shared_cache(dbname, 'wordlist', 'word')
+        # Connection of every thread (self.conn for this one) and the
+        # matches whose urls are in its matchurls table (see match_table)
+        self.local = threading.local()
+        self.local.conn = self.conn
+        self.local.matched = None
+        # Connections the scorer threads opened, closed with the Searcher
+        self.scorer_conns = []
+        if scorer_threads > 0 and dbname != ':memory:':
+            self.pool = ThreadPool(scorer_threads)
+        else:
+            self.pool = None
+        # Seconds every metric took in the last get_score_vector
+        self.timings = {}
+        # Memory-mapped static features, None while they are not up to date
+        self.features = None
+        # Memory-mapped index segments, None until Crawler.update_postings wrote one
+        self.index = None
+        self.cache = QueryCache(cache_entries, cache_bytes) if cache_entries > 0 else None
+        # Matched urls, urls scored and locations gathered in the last get_top_k
+        self.pruning = {}
+        # Query words of the last get_match_rows that are not indexed
+        self.unknown_words = []
 
     def __del__(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        for conn in self.scorer_conns:
+            conn.close()
         self.conn.close()
 
+    def connection(self):
+        """
+        Returns the database connection of the calling thread. A scorer
+        thread opens its own on first use, as a pysqlite connection is
+        used by one thread at a time.
+        
+        :return: database connection
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Only this thread uses it, the Searcher closes it once the pool is gone
+            conn = self.local.conn = sqlite.connect(self.dbname, check_same_thread=False)
+            self.local.matched = None
+            self.scorer_conns.append(conn)
+        return conn
+
+    def generation(self):
+        """
+        :return: index generation the cache checks against, None without cache
+            or for a database no Crawler opened since the counter was added
+        """
+        if self.cache is None:
+            return None
+        return index_generation(self.conn)
+
+    def cache_stats(self):
+        """
+        :return: dict with entries, bytes, evictions and hits, misses and
+            hit_rate for 'query' and 'postings', None without cache
+        """
+        return self.cache.stats() if self.cache is not None else None
+
     def get_match_rows(self, query):
         """
-        Based on the query returns list of tuples 
+        Based on the query returns the urls that match it, each once, with
+        the sorted locations of every query word in it.
         
-        This means the method will return all locations of words from query in one url,
-        and all url's that contain every word from the query. Basically each urlid appears multiple times, 
-        once for every combination of locations.
+        The query has words, "quoted phrases", NEAR/k and AND, OR, NOT
+        and parentheses (see queryparser.py); words next to each other
+        all have to match. Words that are not indexed are left out and
+        listed in self.unknown_words.
         
-        rows e.g.[(urlID, word_locations...), ...]
-        wordids e.g [wordid, ...]
+        Matching runs over the words' posting lists (see invindex.py and
+        segments.py) instead of joining wordlocation with itself, which
+        returned a row for every combination of locations: intersections
+        and unions of their urls, phrases and NEAR checked on their
+        locations. The result is column oriented, matches.rows() gives it as
+        [(urlID, [word0 locations...], [word1 locations...], ...), ...]
+        where OR queries can leave lists empty.
+        
+        wordids e.g [wordid, ...], the words that aren't behind a NOT
         
         :param query: string containing sentence for searching
-        :returns: rows -> list of tuples, wordids -> list of word id's
+        :returns: matches -> invindex.Matches, wordids -> list of word id's
         """
-        # Strings to build the query
-        field_list = 'w0.urlid'  # URL ID from first word from query
-        table_list = ''
-        clause_list = ''
+        tree = queryparser.parse_query(query, ignorewords)
         wordids = []
-
-        # Split the words by spaces
-        words = query.split(' ')
-        table_number = 0
-
-        for word in words:
-            # Get word ID, returns a tuple
-            wordrow = self.conn.execute(
-                "SELECT rowid FROM wordlist WHERE word = '%s'" % word
-            ).fetchone()
-            if wordrow is not None:
-                wordid = wordrow[0]  # Extract word ID from tuple
+        self.unknown_words = []
+        for word in tree.words() if tree is not None else []:
+            # Get word ID, None if the word is not indexed
+            wordid = self.words.get(self.conn, word, createnew=False)
+            if wordid is not None:
                 wordids.append(wordid)
-                # We need to concat query if there are more tables
-                if table_number > 0:
-                    table_list += ','
-                    clause_list += ' and '
-                    clause_list += 'w%d.urlid=w%d.urlid and ' % (table_number - 1, table_number)
-                field_list += ',w%d.location' % table_number  # From table wordlocation
-                table_list += 'wordlocation w%d' % table_number
-                # Extract wordid for every word in wordlocation table
-                clause_list += 'w%d.wordid=%d' % (table_number, wordid)
-                table_number += 1
-        # Create the query from the separate parts
-        # All url's(urlid) contain every word in the query
-        full_query = 'SELECT %s FROM %s WHERE %s' % (field_list, table_list, clause_list)
-        # By the book
-        # print full_query
-        # cur = self.conn.execute(full_query)
-        # rows = [row for row in cur]
-        rows = self.conn.execute(full_query).fetchall()
-        return rows, wordids
-
-    def get_scored_list(self, rows, word_ids):
-        """
-        Scoring result (rows) with various algorithms.
-        
-        :param rows: list of tuples e.g. (urlid, w0.location, w1.location...)
+            else:
+                self.unknown_words.append(word)
+        path = segments.segments_path(self.dbname)
+        while True:
+            generation = self.generation()
+            # Segments the crawler wrote or merged since get mapped now
+            self.index = segments.load_segments(self.conn, path, self.index)
+            matches, matched = self.match_words(tree, wordids, generation)
+            # A commit of Crawler.update_postings in between may have moved
+            # rows from wordlocation into a segment after the lists were
+            # read, then the query is matched again
+            if segments.is_current(self.conn, self.index) and self.generation() == generation:
+                return matches, matched
+
+    def match_words(self, tree, wordids, generation):
+        """
+        Matches the parsed query on the posting lists of self.index.
+        
+        :return: (invindex.Matches, wordids)
+        """
+        index = self.index
+        if index is not None:
+            def read_list(wordid):
+                return segments.read_segment_postings(self.conn, index, wordid)
+        else:
+            last = invindex.merged_location(self.conn)
+            def read_list(wordid):
+                return invindex.read_postings(self.conn, wordid, last)
+
+        def read(wordid):
+            # Posting lists come from the cache while the index is unchanged
+            key = ('postings', wordid)
+            postings = self.cache.get(key, generation)
+            if postings is None:
+                postings = self.cache.put(key, generation, read_list(wordid))
+            return postings
+
+        if self.cache is None:
+            read = read_list
+        # Every list is read once per query
+        lists = {}
+
+        def read_once(wordid):
+            if wordid not in lists:
+                lists[wordid] = read(wordid)
+            return lists[wordid]
+
+        def read_word(word):
+            wordid = self.words.get(self.conn, word, createnew=False)
+            return read_once(wordid) if wordid is not None else None
+
+        urls = tree.urls(read_word) if tree is not None else None
+        if urls is None:
+            # Only words that aren't indexed
+            wordids = []
+        matches = invindex.match_postings(wordids, read_once, urls)
+        return matches, wordids
+
+    def metric_scores(self, matches, word_ids, weights):
+        """
+        Runs the scorers of the metrics of weights, concurrently in the
+        thread pool with scorer_threads. The seconds each one took end up
+        in self.timings.
+        
+        :param matches: invindex.Matches
         :param word_ids: list of word id's from query
-        :return: dict e.g.{urlid: rank}
+        :param weights: list of (weight, metric)
+        :return: dict {metric: array of normalized scores in the order of matches.urlids}
         """
-        total_scores = dict([(row[0], 0) for row in rows])
-
         # Scoring functions
-        weights = [
-            (1.0, self.word_frequency_score(rows)),
-            (1.0, self.location_score(rows)),
-            (1.0, self.distance_score(rows)),
-            (0.5, self.inbound_link_score(rows)),
-            (1.0, self.pagerank_score(rows)),
-            (1.0, self.link_text_score(rows, word_ids)),
-        ]
-
-        for (weight, scores) in weights:
-            for url in total_scores:
-                total_scores[url] += weight * scores[url]
+        metrics = {
+            'frequency': lambda: self.word_frequency_score(matches),
+            'location': lambda: self.location_score(matches),
+            'distance': lambda: self.distance_score(matches),
+            'inbound_link': lambda: self.inbound_link_score(matches),
+            'pagerank': lambda: self.pagerank_score(matches),
+            'link_text': lambda: self.link_text_score(matches, word_ids),
+            'title': lambda: self.title_score(matches, word_ids),
+            'nn': lambda: self.nn_score(matches, word_ids),
+        }
+        def timed(metric):
+            start = time.time()
+            scores = metrics[metric]()
+            return scores, time.time() - start
+
+        if self.pool is None:
+            results = dict((metric, timed(metric)) for (weight, metric) in weights)
+        else:
+            pending = dict((metric, self.pool.apply_async(timed, (metric,)))
+                           for (weight, metric) in weights if metric not in self.same_thread_metrics)
+            results = dict((metric, timed(metric))
+                           for (weight, metric) in weights if metric in self.same_thread_metrics)
+            results.update((metric, result.get()) for (metric, result) in pending.items())
+
+        self.timings = dict((metric, seconds) for (metric, (scores, seconds)) in results.items())
+        return dict((metric, scores) for (metric, (scores, seconds)) in results.items())
 
+    def get_score_vector(self, matches, word_ids):
+        """
+        Scoring result (matches) with various algorithms, weighted by self.weights.
+        
+        Every metric is a normalized array with one score per url of
+        matches, so combining them is a few array operations (see metric_scores).
+        
+        :param matches: invindex.Matches
+        :param word_ids: list of word id's from query
+        :return: array of scores in the order of matches.urlids
+        """
+        weights = [(weight, metric) for (weight, metric) in self.weights if weight]
+        if not len(matches):
+            weights = []
+        results = self.metric_scores(matches, word_ids, weights)
+        total_scores = np.zeros(len(matches))
+        for (weight, metric) in weights:
+            total_scores += weight * results[metric]
         return total_scores
 
+    def get_top_k(self, matches, word_ids, k=10):
+        """
+        The k best urls, computing the metrics of bounded_metrics
+        (distance) only for the urls that can still make the top k.
+        
+        This is not WAND or MaxScore, no url or posting is skipped by
+        per-word upper bounds of frequency, PageRank or inbound links:
+        every posting list is decoded in full and the other metrics are
+        computed for every url. They are normalized by their best value
+        over all matched urls, so a url's score isn't known, nor bounded
+        by any per-list or per-block maximum, before every url has been
+        seen, and skipping would change the top k. They only need the counts
+        and first locations of the words and the static features. A
+        normalized score is at most 1, so a url's total can't exceed their
+        weighted sum plus the weights of the bounded metrics, and the k-th
+        best of those sums is a score the top k reach anyway. Only the urls
+        whose bound reaches it get their locations gathered for distance.
+        
+        The distance score is normalized by the smallest distance of all
+        urls. Once a candidate has the least distance the query allows
+        no other url can go below it, otherwise the rest are computed too.
+        
+        Returns the same as top_k_indices(get_score_vector(...), k), the
+        totals of the candidates are added up in the same order.
+        
+        :param matches: invindex.Matches
+        :param word_ids: list of word id's from query
+        :param k: number of urls
+        :return: indices into matches of the k best urls, best first
+        """
+        weights = [(weight, metric) for (weight, metric) in self.weights if weight]
+        bound = sum(weight for (weight, metric) in weights if metric in self.bounded_metrics)
+        locations = sum(int(matches.counts(w).sum()) for w in range(matches.words()))
+        self.pruning = {'matches': len(matches), 'scored': len(matches),
+                        'locations': locations, 'total_locations': locations}
+        if not bound or len(matches) <= k or min(weight for (weight, metric) in weights) < 0:
+            return top_k_indices(self.get_score_vector(matches, word_ids), k)
+
+        results = self.metric_scores(matches, word_ids, [(weight, metric) for (weight, metric) in weights
+                                                          if metric not in self.bounded_metrics])
+        lower = np.zeros(len(matches))
+        for (weight, metric) in weights:
+            if metric in results:
+                lower += weight * results[metric]
+        threshold = np.partition(lower, len(lower) - k)[len(lower) - k]
+        # The margin covers rounding, the totals are summed in another order
+        selected = np.flatnonzero(lower + bound >= threshold - 1e-9)
+        # Matches whose locations got gathered
+        scored = [matches.subset(selected)]
+
+        bounded = {}
+        if 'distance' in [metric for (weight, metric) in weights]:
+            start = time.time()
+            if matches.words() <= 1:
+                bounded['distance'] = np.ones(len(selected))
+            else:
+                distances = invindex.min_distances(scored[0])
+                least = distances.min()
+                rest = np.setdiff1d(np.arange(len(matches)), selected)
+                # A url with just one of the words (OR queries) has distance 0
+                limit = invindex.least_distance(word_ids) if matches.complete() else 0
+                if least > limit and len(rest):
+                    scored.append(matches.subset(rest))
+                    least = min(least, invindex.min_distances(scored[-1]).min())
+                bounded['distance'] = self.normalize(distances, small_is_better=True, best=least)
+            self.timings['distance'] = time.time() - start
+
+        total_scores = np.zeros(len(selected))
+        for (weight, metric) in weights:
+            total_scores += weight * (bounded[metric] if metric in bounded else results[metric][selected])
+        self.pruning['scored'] = sum(len(m) for m in scored)
+        self.pruning['locations'] = sum(len(m.locations(w)[1]) for m in scored for w in m.gathered)
+        return selected[top_k_indices(total_scores, k)]
+
+    def get_scored_list(self, matches, word_ids):
+        """
+        Scoring result (matches) with various algorithms.
+        
+        :param matches: invindex.Matches
+        :param word_ids: list of word id's from query
+        :return: dict e.g.{urlid: rank}
+        """
+        total_scores = self.get_score_vector(matches, word_ids)
+        return dict(zip(matches.urlids.tolist(), total_scores.tolist()))
+
     def get_url_name(self, id):
         """
         Method returns url name based on urlid.
@@ -346,176 +761,238 @@ class Searcher:
         Method for querying indexed web pages and printing
         best matched url's.
         
+        Results are cached per query words and weights until the
+        index changes (see QueryCache), with the query's unknown words,
+        which a cache hit puts back in self.unknown_words.
+        
         :param q: query string for search
         """
-        rows, word_ids = self.get_match_rows(q)  # Get list of tuples (urlid, wordlocations...)
-        scores = self.get_scored_list(rows, word_ids)
-        # Sort urls for query
-        ranked_scores = sorted([(score, url) for (url, score) in scores.items()], reverse=True)  # reverse = 1 btb
-        # Print 10 most ranked results - btb
-        # for (score, urlid) in ranked_scores[0:10]:
-        #     print '%f\t%s' % (score, self.get_url_name(urlid))
-        return word_ids, [r[1] for r in ranked_scores[0:10]]
-
-    def normalize(self, scores, small_is_better=False):
-        """
-        Method takes a dictionary od IDs and scores and
-        return a new dictionary with same IDs but with scores between 0 and 1
+        generation = self.generation()
+        key = ('query', tuple([word for word in q.split(' ') if word]), tuple(self.weights))
+        if self.cache is not None:
+            result = self.cache.get(key, generation)
+            if result is not None:
+                self.unknown_words = list(result[2])
+                return list(result[0]), list(result[1])
+
+        matches, word_ids = self.get_match_rows(q)
+        # 10 most ranked urls for query
+        ranked_urls = matches.urlids[self.get_top_k(matches, word_ids, 10)].tolist()
+        # for urlid in ranked_urls:
+        #     print '%s' % self.get_url_name(urlid)
+        if self.cache is not None:
+            self.cache.put(key, generation,
+                           (tuple(word_ids), tuple(ranked_urls), tuple(self.unknown_words)))
+        return word_ids, ranked_urls
+
+    def normalize(self, scores, small_is_better=False, best=None):
+        """
+        Method takes an array of scores and returns a new array
+        with scores between 0 and 1
         
-        :param scores: dict of ids and scores
+        :param scores: array of scores
         :param small_is_better: best type of value for scoring algorithm
-        :return: dict of normalized scores
+        :param best: best value to normalize by, when scores are only part of them
+        :return: array of normalized scores
         """
         vsmall = 0.00001  # Avoid dividing by zero
+        scores = np.asarray(scores, dtype=np.float64)
         if small_is_better:
-            minscore = min(scores.values())
-            return dict([(u, float(minscore) / max(vsmall, l)) for (u, l) in scores.items()])
+            minscore = scores.min() if best is None else best
+            return minscore / np.maximum(vsmall, scores)
         else:
-            maxscore = max(scores.values())
+            maxscore = scores.max() if best is None else best
             if maxscore == 0:
                 maxscore = vsmall
-            return dict([(u, float(c) / maxscore) for (u, c) in scores.items()])
+            return scores / maxscore
 
-    def word_frequency_score(self, rows):
+    def word_frequency_score(self, matches):
         """
         Returns score based on frequency of words in document.
         
-        :param rows: list of tuples [(urlid, w0.location, ...), ...]
-        :return: dict of scores
-        """
-        # Create dict {urlid: init_score}
-        counts = dict([(row[0], 0) for row in rows])
-        # Increment score for every occurrence of urlid in row tuple
-        for row in rows:
-            counts[row[0]] += 1
+        :param matches: invindex.Matches
+        :return: array of scores
+        """
+        # Every combination of locations of the query words counts once,
+        # a word the url doesn't have (OR queries) is left out
+        counts = np.ones(len(matches))
+        for w in range(matches.words()):
+            counts *= np.maximum(matches.counts(w), 1)
         return self.normalize(counts)
 
-    def location_score(self, rows):
+    def location_score(self, matches):
         """
         Returns score based on how early words from query occurred
         
-        :param rows: list of tuples [(urlid, w0.location, ...), ...]
-        :return: dict of scores
-        """
-        # Create dict {urlid: init_score}
-        locations = dict([(row[0], 1000000) for row in rows])
-        for row in rows:
-            # Sum all word locations from row tuple
-            loc = sum(row[1:])
-            if loc < locations[row[0]]:
-                locations[row[0]] = loc
+        :param matches: invindex.Matches
+        :return: array of scores
+        """
+        # Sum of the first location of every word, a word the url doesn't
+        # have (OR queries) counts as after every location found
+        firsts = [matches.first_locations(w) for w in range(matches.words())]
+        end = max([f.max() for f in firsts if len(f)] or [0]) + 1
+        locations = np.zeros(len(matches), dtype=np.int64)
+        for f in firsts:
+            locations += np.where(f >= 0, f, end)
         return self.normalize(locations, small_is_better=True)
 
-    def distance_score(self, rows):
+    def distance_score(self, matches):
         """
         Returns score based on how close words in query appear
         to one another in document. Smallest distances are used
         for calculation.
         
-        :param rows: list of tuples [(urlid, w0.location, ...), ...]
-        :return: dict of scores
+        :param matches: invindex.Matches
+        :return: array of scores
         """
         # If there's only one word everyone wins!
-        if len(rows[0]) <= 2:
-            return dict([(row[0], 1.0) for row in rows])
-
-        # Initialize dictionary with large values
-        min_distance = dict([(row[0], 1000000) for row in rows])
+        if matches.words() <= 1:
+            return np.ones(len(matches))
 
-        for row in rows:
-            # Calculating sum of distances between word locations in row tuple.
-            dist = sum([abs(row[i] - row[i - 1]) for i in range(2, len(row))])
-            if dist < min_distance[row[0]]:
-                min_distance[row[0]] = dist
-        return self.normalize(min_distance, small_is_better=True)
+        # Smallest sum of distances between word locations
+        return self.normalize(invindex.min_distances(matches), small_is_better=True)
 
-    def inbound_link_score(self, rows):
+    def static_features(self, matches):
+        """
+        Returns the static features if they were built at the current
+        index generation, mapping a new version when one was committed.
+        Anything committed after them (a crawled page, new links) makes
+        them stale, and the scorers use the database until they are built again.
+        
+        :param matches: invindex.Matches
+        :return: features.Features or None to use the database
+        """
+        static = features.load_features(self.connection(), features.features_path(self.dbname),
+                                        self.features)
+        # Scorer threads may each map a new version, any of them will do
+        self.features = static
+        if static is None or not static.covers(matches.urlids):
+            return None
+        return static
+
+    def match_table(self, matches):
+        """
+        Fills the temporary table matchurls of the calling thread's
+        connection with matches.urlids, once per matches, for the scorers
+        to join with.
+        
+        :param matches: invindex.Matches
+        :return: table name
+        """
+        conn = self.connection()
+        if self.local.matched is not matches:
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS matchurls(urlid INTEGER PRIMARY KEY)')
+            conn.execute('DELETE FROM matchurls')
+            conn.executemany('INSERT INTO matchurls(urlid) VALUES (?)',
+                             [(u,) for u in matches.urlids.tolist()])
+            # Don't keep a transaction (and a lock on the database) open
+            conn.commit()
+            self.local.matched = matches
+        return 'matchurls'
+
+    def inbound_link_score(self, matches):
         """
         Returns score based on how many times page appears in other
         web pages.
         
-        :param rows: list of tuples [(urlid, w0.location, ...), ...]
-        :return: dict of scores
-        """
-        # Create unique set of url's (urlid)
-        unique_urls = set([row[0] for row in rows])
-        # Create dict that counts occurrences of page in
-        # parent web pages with dict comprehension
-        inbound_count = dict(
-            [
-                (
-                    u, self.conn.execute(
-                        'SELECT COUNT(*) FROM link WHERE toid=%d' % u
-                    ).fetchone()[0]
-                ) for u in unique_urls
-            ]
-        )
+        :param matches: invindex.Matches
+        :return: array of scores
+        """
+        static = self.static_features(matches)
+        if static is not None:
+            return self.normalize(static.inbound[matches.urlids])
+        table = self.match_table(matches)
+        # Count occurrences of every page in parent web pages, all in one query
+        inbound_count = [count for (urlid, count) in self.connection().execute(
+            'SELECT m.urlid, (SELECT COUNT(*) FROM link WHERE toid = m.urlid) '
+            'FROM %s m ORDER BY m.urlid' % table
+        )]
         return self.normalize(inbound_count)
 
-    def pagerank_score(self, rows):
+    def pagerank_score(self, matches):
         """
         Returns score based on calculated PageRank algorithm.
         
-        :param rows: list of tuples [(urlid, w0.location, ...), ...]
-        :return: dict of scores
-        """
-        pageranks = dict(
-            [
-                (
-                    row[0], self.conn.execute(
-                        'SELECT score FROM pagerank WHERE urlid=%d' % row[0]
-                    ).fetchone()[0]
-                ) for row in rows
-            ]
-        )
-        # btb
-        # max_rank = max(pageranks.values())
-        # normalizedscores = dict([(u, float(l) / max_rank) for (u, l) in pageranks.items()])
-        # return normalizedscores
+        :param matches: invindex.Matches
+        :return: array of scores
+        """
+        static = self.static_features(matches)
+        if static is not None:
+            return self.normalize(static.pagerank[matches.urlids])
+        table = self.match_table(matches)
+        # Urls without a PageRank get 0. pagerank.urlid has no type, the +
+        # keeps SQLite from converting it, which would rule out its index.
+        pageranks = [score for (urlid, score) in self.connection().execute(
+            'SELECT m.urlid, COALESCE(pagerank.score, 0) FROM %s m '
+            'LEFT JOIN pagerank ON pagerank.urlid = +m.urlid ORDER BY m.urlid' % table
+        )]
         return self.normalize(pageranks)
 
-    def link_text_score(self, rows, wordids):
+    def link_text_score(self, matches, wordids):
         """
         Returns score based on a matching word id's with words
         in a link text. Score for page rises if parent page link text
         have query word occurrences
         
-        :param rows: list of tuples [(urlid, w0.location, ...), ...]
+        :param matches: invindex.Matches
         :param wordids: word id's from query
-        :return: dict of scores
+        :return: array of scores
         """
-        # Initialize dict {urlid: score}
-        link_scores = dict([(row[0], 0) for row in rows])
+        table = self.match_table(matches)
+        link_scores = np.zeros(len(matches))
+        # A word that appears twice in the query counts twice
+        counts = {}
         for wordid in wordids:
-            # Get all results from link table which contains specific word(link_text) in linkwords table
-            cursor = self.conn.execute(
-                'SELECT link.fromid, link.toid FROM linkwords, link '
-                'WHERE wordid = %d AND linkwords.linkid = link.rowid' % wordid
-            )
-            for (fromid, toid) in cursor:
-                # Check if child page is in dict
-                if toid in link_scores:
-                    # Get parents pagerank score
-                    pr = self.conn.execute(
-                        'SELECT score FROM pagerank WHERE urlid = %d' % fromid
-                    ).fetchone()[0]
-                    # Add parent's pagerank score to child score
-                    link_scores[toid] += pr
+            counts[wordid] = counts.get(wordid, 0) + 1
+        # Parent's pagerank score for every link to a matched page with a
+        # query word in its text, added up per child page
+        cursor = self.connection().execute(
+            'SELECT link.toid, SUM(pagerank.score * CASE linkwords.wordid %s END) '
+            'FROM linkwords JOIN link ON link.rowid = linkwords.linkid '
+            'JOIN %s m ON m.urlid = link.toid '
+            'JOIN pagerank ON pagerank.urlid = +link.fromid '
+            'WHERE linkwords.wordid IN (%s) GROUP BY link.toid' % (
+                ' '.join('WHEN %d THEN %d' % item for item in counts.items()),
+                table, ','.join('%d' % wordid for wordid in counts))
+        )
+        for (toid, score) in cursor:
+            link_scores[np.searchsorted(matches.urlids, toid)] = score
         return self.normalize(link_scores)
 
-    def nn_score(self,rows, wordids):
+    def title_score(self, matches, wordids):
+        """
+        Returns score based on how many of the query words
+        are in the page title.
+        
+        :param matches: invindex.Matches
+        :param wordids: word id's from query
+        :return: array of scores
+        """
+        static = self.static_features(matches)
+        if static is not None:
+            return self.normalize(static.title_matches(matches.urlids, wordids))
+        table = self.match_table(matches)
+        title_counts = np.zeros(len(matches))
+        cursor = self.connection().execute(
+            'SELECT titlewords.urlid, COUNT(*) FROM titlewords JOIN %s m ON m.urlid = titlewords.urlid '
+            'WHERE titlewords.wordid IN (%s) GROUP BY titlewords.urlid' % (
+                table, ','.join('%d' % wordid for wordid in set(wordids)))
+        )
+        for (urlid, count) in cursor:
+            title_counts[np.searchsorted(matches.urlids, urlid)] = count
+        return self.normalize(title_counts)
+
+    def nn_score(self, matches, wordids):
         """
         Returns score based on user clicks.
         
-        :param rows: list of tuples [(urlid, w0.location, ...), ...]
+        :param matches: invindex.Matches
         :param wordids: word id's from query
-        :return: dict of scores
+        :return: array of scores
         """
-        # Get unique URL IDs as an ordered list
-        urlids = [urlid for urlid in set([row[0] for row in rows])]
+        urlids = matches.urlids.tolist()
         nn_result = mynet.get_result(wordids, urlids)
-        scores = dict([(urlids[i], nn_result[i]) for i in range(len(urlids))])
-        return self.normalize(scores)
+        return self.normalize(nn_result)
 
 
 if __name__ == '__main__':
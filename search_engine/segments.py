@@ -0,0 +1,286 @@
+import json
+import os
+import shutil
+
+import numpy as np
+from pysqlite2 import dbapi2 as sqlite
+
+from invindex import PostingList, decode_postings, drop_locations, encode_postings, merge_postings, \
+    new_postings, read_postings
+
+ARRAYS = ['wordids', 'urls', 'starts', 'data']
+
+
+class Segment:
+    """
+    An immutable part of the index: the posting lists of the words of
+    some range of wordlocation rows, encoded by encode_postings one
+    after another in data. The term dictionary is the sorted wordids
+    with the number of urls of every list and where it starts in data,
+    the list of wordids[i] being data[starts[i]:starts[i + 1]].
+    """
+    def __init__(self, name, wordids, urls, starts, data):
+        self.name = name
+        self.wordids = wordids
+        self.urls = urls
+        self.starts = starts
+        self.data = data
+
+    def __len__(self):
+        return len(self.wordids)
+
+    def size(self):
+        """
+        :return: number of bytes of the encoded posting lists
+        """
+        return len(self.data)
+
+    def postings(self, wordid):
+        """
+        :return: PostingList of a word, None if the segment doesn't have it
+        """
+        i = np.searchsorted(self.wordids, wordid)
+        if i == len(self.wordids) or self.wordids[i] != wordid:
+            return None
+        return decode_postings(self.data[self.starts[i]:self.starts[i + 1]], self.urls[i])
+
+
+class SegmentIndex:
+    """
+    The segments of a database, oldest first, covering the wordlocation
+    rows up to lastlocation.
+    """
+    def __init__(self, segments, lastlocation):
+        self.segments = segments
+        self.lastlocation = lastlocation
+
+    def names(self):
+        return [segment.name for segment in self.segments]
+
+    def matches(self, manifest):
+        """
+        :return: True if the segments are the ones manifest lists
+        """
+        return manifest is not None and self.names() == manifest['segments'] and \
+            self.lastlocation == manifest['lastlocation']
+
+    def size(self):
+        return sum(segment.size() for segment in self.segments)
+
+    def postings(self, wordid):
+        """
+        :return: PostingList of a word over all segments
+        """
+        postings = PostingList(np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64),
+                               np.zeros(0, dtype=np.int64))
+        for segment in self.segments:
+            found = segment.postings(wordid)
+            if found is not None:
+                postings = merge_postings(postings, found)
+        return postings
+
+
+def segments_path(dbname):
+    """
+    :return: directory of the segments of a database file, None for :memory:
+    """
+    if dbname == ':memory:':
+        return None
+    return dbname + '.segments'
+
+
+def read_manifest(conn):
+    """
+    The manifest is kept in the database, in the segmentmanifest table,
+    so it changes in the same transaction as the wordlocation rows it
+    covers.
+
+    :return: dict with segments (names, oldest first), lastlocation and
+             next (number of the next segment), None if there is none
+    """
+    try:
+        row = conn.execute('SELECT manifest FROM segmentmanifest').fetchone()
+    except sqlite.OperationalError:
+        return None
+    return json.loads(row[0]) if row is not None else None
+
+
+def write_manifest(conn, manifest):
+    """
+    Replaces the manifest, visible to Searchers once conn commits.
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS segmentmanifest(manifest)')
+    conn.execute('DELETE FROM segmentmanifest')
+    conn.execute('INSERT INTO segmentmanifest VALUES (?)', (json.dumps(manifest),))
+
+
+def write_segment(path, name, postings):
+    """
+    Saves posting lists as a segment. The files are written to a
+    temporary directory that is renamed when complete.
+
+    :param path: directory of the segments
+    :param name: segment name
+    :param postings: iterable of (wordid, PostingList) in wordid order
+    :return: Segment
+    """
+    wordids, urls, blobs = [], [], []
+    for wordid, p in postings:
+        if len(p):
+            wordids.append(wordid)
+            urls.append(len(p))
+            blobs.append(encode_postings(p))
+    sizes = np.array([len(blob) for blob in blobs], dtype=np.int64)
+    segment = Segment(name, np.array(wordids, dtype=np.int64), np.array(urls, dtype=np.int64),
+                      np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64),
+                      np.frombuffer(''.join(blobs), dtype=np.uint8))
+    directory = os.path.join(path, name)
+    for leftover in (directory, directory + '.tmp'):
+        # From a run that stopped before it got into the manifest
+        if os.path.exists(leftover):
+            shutil.rmtree(leftover)
+    os.makedirs(directory + '.tmp')
+    for array in ARRAYS:
+        np.save(os.path.join(directory + '.tmp', array + '.npy'), getattr(segment, array))
+    os.rename(directory + '.tmp', directory)
+    return segment
+
+
+def load_segment(path, name):
+    """
+    Memory-maps a segment saved by write_segment.
+    """
+    return Segment(name, *[np.load(os.path.join(path, name, array + '.npy'), mmap_mode='r')
+                           for array in ARRAYS])
+
+
+def load_segments(conn, path, current=None):
+    """
+    Memory-maps the segments of the manifest.
+
+    :param conn: database connection
+    :param path: directory of the segments
+    :param current: SegmentIndex loaded before, returned as it is while
+        the manifest still lists the same segments
+    :return: SegmentIndex or None if no segment was ever written
+    """
+    for attempt in range(3):
+        manifest = read_manifest(conn)
+        if manifest is None or path is None:
+            return None
+        if current is not None and current.matches(manifest):
+            return current
+        try:
+            return SegmentIndex([load_segment(path, name) for name in manifest['segments']],
+                                manifest['lastlocation'])
+        except IOError:
+            # A merge removed a segment after the manifest was read
+            if attempt == 2:
+                raise
+
+
+def is_current(conn, index):
+    """
+    :param index: SegmentIndex or None from load_segments
+    :return: True if no update_segments was committed since index was loaded
+    """
+    manifest = read_manifest(conn)
+    return manifest is None if index is None else index.matches(manifest)
+
+
+def clear_segments(path):
+    """
+    Deletes every segment, for a database whose tables were recreated.
+    """
+    if path is not None and os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def remove_segments(path, names):
+    """
+    Deletes segments merged away, once the manifest without them is committed.
+    """
+    for name in names:
+        shutil.rmtree(os.path.join(path, name))
+
+
+def merge_segments(path, name, segments):
+    """
+    Merges segments into one new segment, word by word in wordid order.
+
+    :return: Segment
+    """
+    def merged():
+        wordids = np.unique(np.concatenate([segment.wordids for segment in segments]))
+        for wordid in wordids.tolist():
+            lists = [p for p in (segment.postings(wordid) for segment in segments) if p is not None]
+            yield wordid, reduce(merge_postings, lists)
+    return write_segment(path, name, merged())
+
+
+def update_segments(conn, path, merge_factor=4):
+    """
+    Writes the wordlocation rows added since the last segment as a new
+    segment and deletes them from wordlocation. Then, as long as the second newest segment is less than
+    merge_factor times as big as the newest, merges the two, so segment
+    sizes grow geometrically and a database has a logarithmic number of
+    them, while every location only gets merged a logarithmic number of times.
+
+    Segments are never changed and only become part of the index when
+    the transaction with the new manifest and the deleted rows commits;
+    until then Searchers keep the old manifest and read the rows from
+    wordlocation. The merged segments have to be deleted (with
+    remove_segments) after that commit, Searchers that mapped them keep
+    reading them until they reload.
+
+    :param conn: database connection
+    :param path: directory of the segments
+    :param merge_factor: size ratio of consecutive segments below which they are merged
+    :return: (number of words in the new segment, number of merges, names of the merged segments)
+    """
+    manifest = read_manifest(conn)
+    # The wordlocation rowid can only go back if the tables were recreated
+    if manifest is not None and manifest['lastlocation'] > \
+            (conn.execute('SELECT MAX(rowid) FROM wordlocation').fetchone()[0] or 0):
+        manifest = None
+    if manifest is None:
+        # Segments of recreated tables, of a database from before the
+        # manifest was kept in it, or of a transaction rolled back
+        clear_segments(path)
+        manifest = {'segments': [], 'lastlocation': 0, 'next': 1}
+    last, added = new_postings(conn, manifest['lastlocation'])
+    if not added:
+        return 0, 0, []
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    def next_name():
+        manifest['next'] += 1
+        return 'segment-%06d' % (manifest['next'] - 1)
+
+    segments = [load_segment(path, name) for name in manifest['segments']]
+    segments.append(write_segment(path, next_name(), added))
+    removed = []
+    merges = 0
+    while len(segments) > 1 and segments[-2].size() < merge_factor * segments[-1].size():
+        removed.extend(segments[-2:])
+        segments[-2:] = [merge_segments(path, next_name(), segments[-2:])]
+        merges += 1
+    manifest['segments'] = [segment.name for segment in segments]
+    manifest['lastlocation'] = last
+    write_manifest(conn, manifest)
+    drop_locations(conn, last)
+    return len(added), merges, [segment.name for segment in removed if segment.name not in manifest['segments']]
+
+
+def read_segment_postings(conn, index, wordid):
+    """
+    PostingList of a word: the segments' plus the wordlocation rows
+    added after them.
+
+    :param conn: database connection
+    :param index: SegmentIndex
+    :param wordid: word id
+    :return: PostingList
+    """
+    return read_postings(conn, wordid, index.lastlocation, index.postings(wordid))
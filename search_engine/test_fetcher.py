@@ -0,0 +1,166 @@
+import BaseHTTPServer
+import SocketServer
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import searchengine
+from fetcher import FetchPool
+
+# Forty small pages, every one linking to five others (the first one
+# twice). Neighbours link to each other, so the crawl finds pages again
+# after they have been indexed.
+PAGES = {}
+for number in range(40):
+    links = [(number + step) % 40 for step in (1, 2, 38, 39)] + [(number * 7 + 11) % 40]
+    links.append(links[0])
+    PAGES['/p%d.html' % number] = (
+        '<html><head><title>Page %d</title></head><body><p>%s</p>%s</body></html>' % (
+            number, ' '.join('word%d' % ((number + i) % 13) for i in range(30)),
+            ' '.join('<a href="p%d.html">link %d</a>' % (link, link) for link in links)))
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            server.connections.add(self.client_address)
+        try:
+            time.sleep(server.latency)
+            if self.path == '/moved':
+                self.send_response(302)
+                self.send_header('Location', '/p0.html')
+                body = ''
+            elif self.path in PAGES:
+                self.send_response(200)
+                body = PAGES[self.path]
+            else:
+                self.send_response(404)
+                body = 'not found'
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FixtureServerTest(unittest.TestCase):
+    """
+    Runs the fetcher and the crawler against pages served from
+    127.0.0.1, so no test needs the network.
+    """
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.lock = threading.Lock()
+        self.server.requests = self.server.active = self.server.max_active = 0
+        self.server.connections = set()
+        self.server.latency = 0.01
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.root = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def fetch_all(self, pool, urls):
+        for url in urls:
+            pool.submit(url, 0)
+        results = {}
+        for url in urls:
+            url, level, html = pool.results.get(timeout=10)
+            results[url] = html
+        return results
+
+    def test_fetch(self):
+        pool = FetchPool(workers=2)
+        try:
+            results = self.fetch_all(pool, [self.root + '/p1.html', self.root + '/missing',
+                                            self.root + '/moved'])
+        finally:
+            pool.close()
+        self.assertEqual(results[self.root + '/p1.html'], PAGES['/p1.html'])
+        self.assertIsNone(results[self.root + '/missing'])
+        # The redirect is followed
+        self.assertEqual(results[self.root + '/moved'], PAGES['/p0.html'])
+
+    def test_keep_alive(self):
+        pool = FetchPool(workers=1)
+        try:
+            self.fetch_all(pool, [self.root + '/p%d.html' % number for number in range(10)])
+        finally:
+            pool.close()
+        self.assertEqual(self.server.requests, 10)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_per_host_limit(self):
+        self.server.latency = 0.05
+        pool = FetchPool(workers=8, per_host=3)
+        try:
+            self.fetch_all(pool, [self.root + '/p%d.html' % number for number in range(24)])
+        finally:
+            pool.close()
+        self.assertLessEqual(self.server.max_active, 3)
+        self.assertGreater(self.server.max_active, 1)
+
+    def crawl(self, name, **options):
+        crawler = searchengine.Crawler(os.path.join(self.directory, name))
+        crawler.create_index_tables()
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            crawler.crawl([self.root + '/p0.html'], depth=3, **options)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        urls = sorted(row[0] for row in crawler.conn.execute('SELECT url FROM urllist'))
+        links = sorted(crawler.conn.execute(
+            'SELECT f.url, t.url, (SELECT COUNT(*) FROM linkwords WHERE linkid = link.rowid) '
+            'FROM link JOIN urllist f ON f.rowid = link.fromid '
+            'JOIN urllist t ON t.rowid = link.toid').fetchall())
+        locations = crawler.conn.execute('SELECT SUM(length) FROM pagelength').fetchone()[0]
+        # The crawl ends with every location moved into the segments but
+        # the last one, which keeps the rowids growing
+        self.assertLessEqual(crawler.conn.execute('SELECT COUNT(*) FROM wordlocation').fetchone()[0], 1)
+        crawler.conn.close()
+        return urls, links, locations
+
+    def test_concurrent_crawl_matches_serial(self):
+        serial = self.crawl('serial.db')
+        requests = self.server.requests
+        concurrent = self.crawl('concurrent.db', workers=8, per_host=4)
+        self.assertEqual(serial, concurrent)
+        # Pages are fetched once per crawl, in both modes
+        self.assertEqual(self.server.requests - requests, requests)
+        # Every indexed page has one link per anchor, stored once
+        anchors = re.compile('href="([^"]*)"')
+        for page in set(f for f, t, words in serial[1]):
+            stored = sorted(t for f, t, words in serial[1] if f == page)
+            expected = sorted(self.root + '/' + url for url in anchors.findall(PAGES[page[len(self.root):]])
+                              if self.root + '/' + url != page)
+            self.assertEqual(stored, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
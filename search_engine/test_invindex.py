@@ -0,0 +1,97 @@
+import random
+import unittest
+
+import numpy as np
+from pysqlite2 import dbapi2 as sqlite
+
+import invindex
+from invindex import decode_postings, decode_varints, encode_postings, encode_varints, posting_list
+
+
+def random_postings(rand, urls, positions):
+    """
+    :return: (PostingList, set of its (urlid, position) pairs)
+    """
+    pairs = set((rand.randrange(1, urls), rand.randrange(positions))
+                for i in range(rand.randrange(1, 200)))
+    postings = posting_list([urlid for urlid, position in pairs],
+                            [position for urlid, position in pairs])
+    return postings, pairs
+
+
+def pair_set(postings):
+    urlids, positions = postings.pairs()
+    return set(zip(urlids.tolist(), positions.tolist()))
+
+
+class CodecTest(unittest.TestCase):
+    """
+    The varint and delta encodings decode to what was encoded.
+    """
+    def test_varints(self):
+        values = [0, 1, 127, 128, 255, 16383, 16384, 2 ** 21 - 1, 2 ** 21, 2 ** 35 + 3, 2 ** 62]
+        data = encode_varints(values)
+        # One byte per 7 bits
+        self.assertEqual(len(data), sum(max(1, (value.bit_length() + 6) // 7) for value in values))
+        self.assertEqual(decode_varints(data).tolist(), values)
+        self.assertEqual(encode_varints([]), '')
+        self.assertEqual(decode_varints('').tolist(), [])
+        rand = random.Random(1)
+        values = [rand.randrange(2 ** rand.randrange(1, 50)) for i in range(5000)]
+        self.assertEqual(decode_varints(buffer(encode_varints(values))).tolist(), values)
+
+    def test_postings(self):
+        rand = random.Random(2)
+        for urls, positions in [(2, 5), (50, 10), (10 ** 6, 3000)]:
+            for i in range(20):
+                postings, pairs = random_postings(rand, urls, positions)
+                decoded = decode_postings(encode_postings(postings), len(postings))
+                self.assertEqual(decoded.urlids.tolist(), postings.urlids.tolist())
+                self.assertEqual(decoded.offsets.tolist(), postings.offsets.tolist())
+                self.assertEqual(pair_set(decoded), pairs)
+
+    def test_empty_postings(self):
+        postings = posting_list([], [])
+        self.assertEqual(len(postings), 0)
+        decoded = decode_postings(encode_postings(postings), 0)
+        self.assertEqual(len(decoded), 0)
+        self.assertEqual(decoded.offsets.tolist(), [0])
+
+    def test_merge(self):
+        rand = random.Random(3)
+        for urls in (5, 1000):
+            for i in range(20):
+                first, first_pairs = random_postings(rand, urls, 50)
+                second, second_pairs = random_postings(rand, urls, 50)
+                merged = invindex.merge_postings(first, second)
+                self.assertEqual(pair_set(merged), first_pairs | second_pairs)
+                self.assertTrue((np.diff(merged.urlids) > 0).all())
+
+
+class PostingsTableTest(unittest.TestCase):
+    """
+    update_postings moves wordlocation into the postings table without
+    changing what read_postings finds.
+    """
+    def test_update_postings(self):
+        conn = sqlite.connect(':memory:')
+        conn.execute('CREATE TABLE wordlocation(urlid, wordid, location)')
+        rand = random.Random(4)
+        expected = {}
+        for batch in range(5):
+            rows = [(rand.randrange(1, 30), rand.randrange(1, 20), rand.randrange(100))
+                    for i in range(300)]
+            conn.executemany('INSERT INTO wordlocation VALUES (?, ?, ?)', rows)
+            for urlid, wordid, location in rows:
+                expected.setdefault(wordid, set()).add((urlid, location))
+            if batch < 4:
+                # The last batch is only in wordlocation
+                invindex.update_postings(conn)
+                self.assertLessEqual(conn.execute('SELECT COUNT(*) FROM wordlocation').fetchone()[0], 1)
+            for wordid, pairs in expected.items():
+                self.assertEqual(pair_set(invindex.read_postings(conn, wordid)), pairs)
+        self.assertEqual(len(invindex.read_postings(conn, 1000)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
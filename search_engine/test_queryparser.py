@@ -0,0 +1,160 @@
+import random
+import unittest
+
+from invindex import posting_list
+from queryparser import Near, Not, Phrase, Word, parse_query
+
+
+def describe(part):
+    """
+    :return: the parsed query as nested tuples, for comparing
+    """
+    if part is None:
+        return None
+    if isinstance(part, Word):
+        return part.word
+    if isinstance(part, Phrase):
+        return ('phrase', tuple(part.phrase), tuple(part.offsets))
+    if isinstance(part, Near):
+        return ('near', describe(part.left), describe(part.right), part.distance)
+    if isinstance(part, Not):
+        return ('not', describe(part.part))
+    return (part.__class__.__name__.lower(),) + tuple(describe(p) for p in part.parts)
+
+
+class GrammarTest(unittest.TestCase):
+    def check(self, query, expected, ignore=()):
+        self.assertEqual(describe(parse_query(query, ignore)), expected, query)
+
+    def test_operators(self):
+        self.check('a', 'a')
+        self.check('a b', ('and', 'a', 'b'))
+        self.check('a AND b', ('and', 'a', 'b'))
+        self.check('a OR b c', ('or', 'a', ('and', 'b', 'c')))
+        self.check('a b OR c', ('or', ('and', 'a', 'b'), 'c'))
+        self.check('NOT a b', ('and', ('not', 'a'), 'b'))
+        self.check('a NOT NOT b', ('and', 'a', ('not', ('not', 'b'))))
+        # Operators are upper case
+        self.check('a or not b', ('and', 'a', 'or', 'not', 'b'))
+
+    def test_parentheses(self):
+        self.check('(a OR b) c', ('and', ('or', 'a', 'b'), 'c'))
+        self.check('a (b (c OR d))', ('and', 'a', ('and', 'b', ('or', 'c', 'd'))))
+        # A missing ')' is at the end, a stray one is left out
+        self.check('(a OR b', ('or', 'a', 'b'))
+        self.check('a) b', ('and', 'a', 'b'))
+        self.check(')', None)
+
+    def test_missing_operands(self):
+        self.check('', None)
+        self.check('OR a', 'a')
+        self.check('a OR', 'a')
+        self.check('a NOT', 'a')
+        self.check('NOT', None)
+        self.check('a NEAR/2', 'a')
+        self.check('NEAR/2 a', 'a')
+        self.check('()', None)
+
+    def test_phrases(self):
+        self.check('"a b c"', ('phrase', ('a', 'b', 'c'), (0, 1, 2)))
+        self.check('"a"', 'a')
+        self.check('""', None)
+        # Ignored words keep their place in a phrase
+        self.check('"a the b"', ('phrase', ('a', 'b'), (0, 2)), ignore=['the'])
+        self.check('"the a"', 'a', ignore=['the'])
+        self.check('the a', 'a', ignore=['the'])
+        self.check('"the"', None, ignore=['the'])
+
+    def test_near(self):
+        self.check('a NEAR/3 b', ('near', 'a', 'b', 3))
+        self.check('a NEAR/3 b NEAR/1 c', ('near', ('near', 'a', 'b', 3), 'c', 1))
+        self.check('"a b" NEAR/0 c', ('near', ('phrase', ('a', 'b'), (0, 1)), 'c', 0))
+        # NEAR binds tighter than AND and OR
+        self.check('a b NEAR/2 c OR d', ('or', ('and', 'a', ('near', 'b', 'c', 2)), 'd'))
+        # Between a group and something else it is an AND
+        self.check('(a OR b) NEAR/2 c', ('and', ('or', 'a', 'b'), 'c'))
+        self.check('a NEAR/2 NOT b', ('and', 'a', ('not', 'b')))
+
+    def test_words(self):
+        self.assertEqual(parse_query('a NOT b "c d" NEAR/2 e').words(), ['a', 'c', 'd', 'e'])
+
+
+class Documents:
+    """
+    Random documents over a few words, with their posting lists.
+    """
+    def __init__(self, rand, count=200, length=30, vocabulary='abcde'):
+        self.documents = [[rand.choice(vocabulary) for i in range(length)] for urlid in range(count)]
+        self.postings = {}
+        for word in vocabulary:
+            pairs = [(urlid, position) for urlid, document in enumerate(self.documents)
+                     for position, w in enumerate(document) if w == word]
+            self.postings[word] = posting_list([urlid for urlid, position in pairs],
+                                               [position for urlid, position in pairs])
+
+    def read(self, word):
+        return self.postings.get(word)
+
+    def locations(self, part, document):
+        """
+        :return: (places where part matches in document, span), the brute force way
+        """
+        if isinstance(part, Word):
+            return set(p for p, w in enumerate(document) if w == part.word), 0
+        if isinstance(part, Phrase):
+            first = part.offsets[0]
+            found = set(p for p in range(len(document))
+                        if all(p + offset - first < len(document) and document[p + offset - first] == word
+                               for word, offset in zip(part.phrase, part.offsets)))
+            return found, part.offsets[-1] - first
+        left, left_span = self.locations(part.left, document)
+        right, right_span = self.locations(part.right, document)
+        # From the end of one part to the start of the other, 0 if they overlap
+        found = set(a for a in left
+                    if any(max(0, b - (a + left_span), a - (b + right_span)) <= part.distance for b in right))
+        return found, left_span
+
+
+class MatchTest(unittest.TestCase):
+    """
+    Phrase and NEAR matches of posting lists are the ones found by
+    looking at every place of every document.
+    """
+    def random_part(self, rand, depth):
+        choice = rand.randrange(3) if depth else rand.randrange(2)
+        if choice == 0:
+            return Word(rand.choice('abcde'))
+        if choice == 1:
+            offsets = sorted(rand.sample(range(4), rand.randrange(2, 4)))
+            return Phrase([rand.choice('abcde') for offset in offsets], offsets)
+        return Near(self.random_part(rand, depth - 1), self.random_part(rand, depth - 1), rand.randrange(5))
+
+    def test_against_brute_force(self):
+        rand = random.Random(6)
+        documents = Documents(rand)
+        for i in range(300):
+            part = self.random_part(rand, 2)
+            postings = part.postings(documents.read)
+            expected = dict((urlid, documents.locations(part, document)[0])
+                            for urlid, document in enumerate(documents.documents))
+            self.assertEqual(postings.urlids.tolist(), [urlid for urlid in sorted(expected) if expected[urlid]],
+                             describe(part))
+            for i, urlid in enumerate(postings.urlids.tolist()):
+                self.assertEqual(set(postings.locations(i).tolist()), expected[urlid], describe(part))
+
+    def test_parsed_queries(self):
+        rand = random.Random(7)
+        documents = Documents(rand)
+        for query, expected in [
+            ('"a b" NEAR/1 c', lambda d: documents.locations(Near(Phrase(['a', 'b'], [0, 1]), Word('c'), 1), d)[0]),
+            ('a NEAR/1 b', lambda d: any(d[p] + d[p + 1] in ('ab', 'ba') for p in range(len(d) - 1))),
+            ('"a b c" NOT d', lambda d: 'abc' in ''.join(d) and 'd' not in d),
+            ('"a b" OR "c d"', lambda d: 'ab' in ''.join(d) or 'cd' in ''.join(d)),
+        ]:
+            found = parse_query(query).urls(documents.read).tolist()
+            self.assertEqual(found, [urlid for urlid, document in enumerate(documents.documents)
+                                     if expected(document)], query)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from pysqlite2 import dbapi2 as sqlite
+
+import segments
+
+
+class SegmentsTest(unittest.TestCase):
+    """
+    Flushing wordlocation into segments and merging them keeps the
+    posting list of every word what wordlocation had.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.db.segments')
+        self.conn = sqlite.connect(os.path.join(self.directory, 'test.db'))
+        self.conn.execute('CREATE TABLE wordlocation(urlid, wordid, location)')
+        self.rand = random.Random(5)
+        self.expected = {}
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def add_locations(self, count):
+        rows = [(self.rand.randrange(1, 50), self.rand.randrange(1, 40), self.rand.randrange(200))
+                for i in range(count)]
+        self.conn.executemany('INSERT INTO wordlocation VALUES (?, ?, ?)', rows)
+        return rows
+
+    def check(self, index):
+        for wordid, pairs in self.expected.items():
+            urlids, positions = segments.read_segment_postings(self.conn, index, wordid).pairs()
+            self.assertEqual(set(zip(urlids.tolist(), positions.tolist())), pairs)
+
+    def flush(self):
+        words, merges, removed = segments.update_segments(self.conn, self.path)
+        self.conn.commit()
+        segments.remove_segments(self.path, removed)
+        return merges
+
+    def test_flush_and_merge(self):
+        merges = 0
+        for batch in range(12):
+            for urlid, wordid, location in self.add_locations(200):
+                self.expected.setdefault(wordid, set()).add((urlid, location))
+            merges += self.flush()
+            self.assertLessEqual(self.conn.execute('SELECT COUNT(*) FROM wordlocation').fetchone()[0], 1)
+            index = segments.load_segments(self.conn, self.path)
+            self.check(index)
+            # Only the segments of the manifest are left on disk
+            self.assertEqual(sorted(os.listdir(self.path)), sorted(index.names()))
+        self.assertGreater(merges, 0)
+        self.assertLess(len(index.segments), 12)
+        # Rows added after the last flush are read from wordlocation
+        for urlid, wordid, location in self.add_locations(100):
+            self.expected.setdefault(wordid, set()).add((urlid, location))
+        self.check(index)
+        self.assertTrue(segments.is_current(self.conn, index))
+
+    def test_rollback(self):
+        for urlid, wordid, location in self.add_locations(300):
+            self.expected.setdefault(wordid, set()).add((urlid, location))
+        self.flush()
+        index = segments.load_segments(self.conn, self.path)
+        for urlid, wordid, location in self.add_locations(300):
+            self.expected.setdefault(wordid, set()).add((urlid, location))
+        self.conn.commit()
+        # A flush that is rolled back leaves the committed manifest and rows
+        segments.update_segments(self.conn, self.path)
+        self.conn.rollback()
+        self.assertTrue(segments.is_current(self.conn, index))
+        self.check(segments.load_segments(self.conn, self.path, index))
+        self.flush()
+        self.assertFalse(segments.is_current(self.conn, index))
+        self.check(segments.load_segments(self.conn, self.path, index))
+
+
+if __name__ == '__main__':
+    unittest.main()
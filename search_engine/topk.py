@@ -0,0 +1,28 @@
+import numpy as np
+
+
+def top_k_indices(scores, k, exclude=None):
+    """
+    Indices of the k highest values of a score array, best first, where
+    the index breaks ties (the larger one first, as sort() and
+    reverse() of (score, index) pairs would). argpartition finds the
+    k-th best score and only the entries reaching it are sorted.
+
+    Same as top_k_indices in recommender_systems/topk.py; the chapters
+    are run from their own directories, so each keeps its copy.
+
+    :param scores: array of scores
+    :param k: number of indices, None ranks everything
+    :param exclude: an index to leave out
+    :return: index array
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    candidates = np.arange(len(scores))
+    if exclude is not None:
+        candidates = candidates[candidates != exclude]
+    if k is not None and 0 < k < len(candidates):
+        cut = len(candidates) - k
+        kth = scores[candidates[np.argpartition(scores[candidates], cut)[cut]]]
+        candidates = candidates[scores[candidates] >= kth]
+    order = np.lexsort((candidates, scores[candidates]))[::-1]
+    return candidates[order[0:k]]